@@ -4,16 +4,34 @@ For more details about this platform, please refer to the documentation at
 https://github.com/custom-components/sensor.owlintuition/blob/master/sensor.owlintuition.markdown
 """
 
+from array import array
 import asyncio
+from bisect import bisect_left
+from collections import Counter, deque
+import cProfile
+import functools
+from dataclasses import asdict, dataclass
+from datetime import timedelta
+import gzip
+import os
+import queue
+import re
 import socket
+import struct
+import sys
+import threading
+import time
+import zlib
 from xml.etree import ElementTree as ET
-from select import select
 
+import io
 import logging
+import pstats
 import voluptuous as vol
 
 from homeassistant.components.sensor import (
     PLATFORM_SCHEMA,
+    RestoreSensor,
     SensorDeviceClass,
     SensorEntity,
     SensorStateClass,
@@ -22,29 +40,62 @@ from homeassistant.config_entries import ConfigEntry
 from homeassistant.const import (
     CONF_BROADCAST_ADDRESS,
     CONF_BROADCAST_PORT,
+    CONF_DEVICE_ID,
     CONF_HOST,
     CONF_MODE,
     CONF_MONITORED_CONDITIONS,
     CONF_NAME,
     CONF_PORT,
+    EVENT_HOMEASSISTANT_STOP,
     PERCENTAGE,
+    UnitOfTime,
     SIGNAL_STRENGTH_DECIBELS_MILLIWATT,
     UnitOfElectricPotential,
     UnitOfEnergy,
     UnitOfPower,
     UnitOfTemperature,
 )
-from homeassistant.core import HomeAssistant
+from homeassistant.core import HomeAssistant, ServiceCall, SupportsResponse, callback
+from homeassistant.exceptions import PlatformNotReady
+from homeassistant.helpers.entity import EntityCategory
 from homeassistant.helpers.entity_platform import AddEntitiesCallback
+from homeassistant.helpers.event import async_call_later, async_track_time_interval
+from homeassistant.helpers.storage import Store
 from homeassistant.helpers.typing import ConfigType
 import homeassistant.helpers.config_validation as cv
+from homeassistant.util import slugify
 
 
 # Configuration properties
 CONF_COST_UNIT_OF_MEASUREMENT = 'cost_unit_of_measurement'
 CONF_COST_ICON = 'cost_icon'
+CONF_DECODER = 'decoder'
+CONF_DIAGNOSTICS = 'diagnostics'
+CONF_STALE_AFTER = 'stale_after'
+CONF_DIAGNOSTICS_SENSORS = 'sensors'
+CONF_DIAGNOSTICS_PROFILE = 'profile_every'
+CONF_HISTORY = 'history'
+CONF_HISTORY_SIZE = 'size'
+CONF_HISTORY_WINDOWS = 'windows'
+CONF_HISTORY_PERCENTILES = 'percentiles'
+CONF_LIFETIME_ENERGY = 'lifetime_energy'
+CONF_PERSIST = 'persist'
+CONF_CAPTURE = 'capture'
+CONF_CAPTURE_PATH = 'path'
+CONF_CAPTURE_MAX_SIZE = 'max_size'
+CONF_CAPTURE_FILES = 'files'
+CONF_CAPTURE_COMPRESS = 'compress'
+CONF_EXPORTER = 'exporter'
+CONF_THROTTLE = 'throttle'
+CONF_DISCOVERY = 'discovery'
+CONF_WORKERS = 'workers'
+CONF_THROTTLE_MIN_INTERVAL = 'min_interval'
+CONF_THROTTLE_DELTA = 'delta'
+CONF_THROTTLE_DELTA_PCT = 'delta_pct'
+CONF_THROTTLE_HEARTBEAT = 'heartbeat'
 
 # OWL-specific constants
+DOMAIN = 'owlintuition'
 VERSION = '1.7.0'
 DEFAULT_NAME = 'OWL Intuition'
 MODE_MONO = 'monophase'
@@ -53,6 +104,8 @@ CONF_ZONES = 'zones'   # this existed in HA at some point
 POWERED_BY = 'Powered by OWL Intuition'
 DEFAULT_BROADCAST_PORT = 22600
 DEFAULT_BROADCAST_ADDRESS = '224.192.32.19'
+DECODER_TREE = 'tree'
+DECODER_FAST = 'fast'
 
 SENSOR_ELECTRICITY_BATTERY = 'electricity_battery'
 SENSOR_ELECTRICITY_BATTERY_LVL = 'electricity_battery_lvl'
@@ -79,6 +132,9 @@ SENSOR_HEATING_CURRENT = 'heating_current'
 SENSOR_HEATING_REQUIRED = 'heating_required'
 SENSOR_HEATING_STATE = 'heating_state'
 SENSOR_RELAYS_RADIO = 'relays_radio'
+SENSOR_ELECTRICITY_ENERGY_TOTAL = 'electricity_energy_total'
+SENSOR_SOLAR_GENERGY_TOTAL = 'solargen_total'
+SENSOR_SOLAR_EENERGY_TOTAL = 'solarexp_total'
 
 #
 # Sensors selected by defining which classes to monitor
@@ -124,6 +180,47 @@ SENSOR_TYPES = {
     SENSOR_RELAYS_RADIO: ['Relays Radio', SIGNAL_STRENGTH_DECIBELS_MILLIWATT, 'mdi:signal', OWLCLASS_RELAYS, SensorDeviceClass.SIGNAL_STRENGTH, SensorStateClass.MEASUREMENT],
 }
 
+# Lifetime energy sensors, integrated locally from the power readings
+ENERGY_SENSOR_TYPES = {
+    SENSOR_ELECTRICITY_ENERGY_TOTAL: ['Electricity Total', UnitOfEnergy.KILO_WATT_HOUR, 'mdi:flash', OWLCLASS_ELECTRICITY, SensorDeviceClass.ENERGY, SensorStateClass.TOTAL_INCREASING],
+    SENSOR_SOLAR_GENERGY_TOTAL: ['Solar Generated Total', UnitOfEnergy.KILO_WATT_HOUR, 'mdi:flash', OWLCLASS_SOLAR, SensorDeviceClass.ENERGY, SensorStateClass.TOTAL_INCREASING],
+    SENSOR_SOLAR_EENERGY_TOTAL: ['Solar Exported Total', UnitOfEnergy.KILO_WATT_HOUR, 'mdi:flash', OWLCLASS_SOLAR, SensorDeviceClass.ENERGY, SensorStateClass.TOTAL_INCREASING],
+}
+
+# The power sensor each lifetime energy sensor integrates
+ENERGY_SOURCES = {
+    SENSOR_ELECTRICITY_ENERGY_TOTAL: SENSOR_ELECTRICITY_POWER,
+    SENSOR_SOLAR_GENERGY_TOTAL: SENSOR_SOLAR_GPOWER,
+    SENSOR_SOLAR_EENERGY_TOTAL: SENSOR_SOLAR_EPOWER,
+}
+# and the other way round
+ENERGY_READINGS = {power: energy for energy, power in ENERGY_SOURCES.items()}
+
+DIAGNOSTIC_PACKETS_ACCEPTED = 'packets_accepted'
+DIAGNOSTIC_PACKETS_DROPPED = 'packets_dropped'
+DIAGNOSTIC_PACKET_ERRORS = 'packet_errors'
+DIAGNOSTIC_DECODE_TIME = 'decode_time'
+DIAGNOSTIC_WRITE_LATENCY = 'state_write_latency'
+DIAGNOSTIC_PACKET_AGE = 'packet_age'
+
+# Diagnostic sensors: name, unit, icon, state class, and how to get
+# their value out of the OwlData and the class they refer to, if any
+DIAGNOSTIC_TYPES = {
+    DIAGNOSTIC_PACKETS_ACCEPTED: ['Packets Accepted', None, 'mdi:counter', SensorStateClass.TOTAL_INCREASING,
+        lambda d, c: d.counters[COUNTER_ACCEPTED]],
+    DIAGNOSTIC_PACKETS_DROPPED: ['Packets Dropped', None, 'mdi:counter', SensorStateClass.TOTAL_INCREASING,
+        lambda d, c: d.counters[COUNTER_DUPLICATE] + d.counters[COUNTER_STALE] + d.counters[COUNTER_IGNORED] +
+                     d.counters[COUNTER_QUEUE_DROPPED]],
+    DIAGNOSTIC_PACKET_ERRORS: ['Packet Errors', None, 'mdi:alert-circle-outline', SensorStateClass.TOTAL_INCREASING,
+        lambda d, c: d.counters[COUNTER_UNPARSEABLE] + d.listener_counters[COUNTER_TRUNCATED]],
+    DIAGNOSTIC_DECODE_TIME: ['Decode Time', UnitOfTime.MICROSECONDS, 'mdi:timer-outline', SensorStateClass.MEASUREMENT,
+        lambda d, c: d.histograms[HISTOGRAM_DECODE].as_dict()['mean_us']],
+    DIAGNOSTIC_WRITE_LATENCY: ['State Write Latency P95', UnitOfTime.MICROSECONDS, 'mdi:timer-outline', SensorStateClass.MEASUREMENT,
+        lambda d, c: d.histograms[HISTOGRAM_WRITE].percentile(95)],
+    DIAGNOSTIC_PACKET_AGE: ['Packet Age', UnitOfTime.SECONDS, 'mdi:clock-outline', SensorStateClass.MEASUREMENT,
+        lambda d, c: round(d.last_packet_age(c)) if c in d.last_seen else None],
+}
+
 HEATING_STATE = [   'Standby',                      # 0
                     'Comfort (Running)',            # 1
                     '',                             # 2
@@ -140,15 +237,74 @@ HOTWATER_STATE = [  'Standby',                      # 0
                     'Warm Up',                      # 5
                     'Cool Down',                    # 6
                     'Standby (Running)' ]           # 7
+ZONE_STATES = {
+    OWLCLASS_HEATING: HEATING_STATE,
+    OWLCLASS_HOTWATER: HOTWATER_STATE,
+}
 
 DEFAULT_MONITORED = [ OWLCLASS_ELECTRICITY ]
 
+# Seconds without data after which the sensors of a class become
+# unavailable: the OWL station sends electricity and solar data about
+# every 12 seconds, and heating, hot water and relays data every minute
+DEFAULT_STALE_AFTER = {
+    OWLCLASS_WEATHER: 3600,
+    OWLCLASS_ELECTRICITY: 60,
+    OWLCLASS_SOLAR: 60,
+    OWLCLASS_HOTWATER: 300,
+    OWLCLASS_HEATING: 300,
+    OWLCLASS_RELAYS: 300,
+}
+WATCHDOG_INTERVAL = timedelta(seconds=10)
+
+# The last snapshots are saved at most once per delay (in seconds), and
+# in any case when HA shuts down
+SNAPSHOTS_STORAGE_VERSION = 1
+SNAPSHOTS_SAVE_DELAY = 60
+
+HISTORY_SCHEMA = vol.Schema({
+    vol.Optional(CONF_HISTORY_SIZE, default=360):
+        vol.All(vol.Coerce(int), vol.Range(min=2)),
+    vol.Optional(CONF_HISTORY_WINDOWS, default=[300]):
+        vol.All(cv.ensure_list, [vol.All(vol.Coerce(int), vol.Range(min=1))]),
+    vol.Optional(CONF_HISTORY_PERCENTILES, default=[]):
+        vol.All(cv.ensure_list, [vol.All(vol.Coerce(float), vol.Range(min=0, max=100))]),
+})
+
+DIAGNOSTICS_SCHEMA = vol.Schema({
+    vol.Optional(CONF_DIAGNOSTICS_SENSORS, default=False): cv.boolean,
+    vol.Optional(CONF_DIAGNOSTICS_PROFILE, default=0):
+        vol.All(vol.Coerce(int), vol.Range(min=0)),
+})
+
+CAPTURE_SCHEMA = vol.Schema({
+    vol.Optional(CONF_CAPTURE_PATH): cv.string,
+    vol.Optional(CONF_CAPTURE_MAX_SIZE, default=10 * 1024 * 1024):
+        vol.All(vol.Coerce(int), vol.Range(min=1024)),
+    vol.Optional(CONF_CAPTURE_FILES, default=5):
+        vol.All(vol.Coerce(int), vol.Range(min=1)),
+    vol.Optional(CONF_CAPTURE_COMPRESS, default=False): cv.boolean,
+})
+
+EXPORTER_SCHEMA = vol.Schema({
+    vol.Required(CONF_PORT): cv.port,
+    vol.Optional(CONF_HOST, default='127.0.0.1'): cv.string,
+})
+
+THROTTLE_SCHEMA = vol.Schema({
+    vol.Optional(CONF_THROTTLE_MIN_INTERVAL): vol.All(vol.Coerce(float), vol.Range(min=0)),
+    vol.Optional(CONF_THROTTLE_DELTA): vol.All(vol.Coerce(float), vol.Range(min=0)),
+    vol.Optional(CONF_THROTTLE_DELTA_PCT): vol.All(vol.Coerce(float), vol.Range(min=0)),
+    vol.Optional(CONF_THROTTLE_HEARTBEAT): vol.All(vol.Coerce(float), vol.Range(min=1)),
+})
+
 PLATFORM_SCHEMA = PLATFORM_SCHEMA.extend({
     vol.Optional(CONF_PORT): cv.port,
     vol.Optional(CONF_HOST, default='localhost'): cv.string,
     vol.Optional(CONF_BROADCAST_PORT, default=DEFAULT_BROADCAST_PORT): cv.port,
     vol.Optional(CONF_BROADCAST_ADDRESS, default=DEFAULT_BROADCAST_ADDRESS): cv.string,
     vol.Optional(CONF_NAME, default=DEFAULT_NAME): cv.string,
+    vol.Optional(CONF_DEVICE_ID): cv.string,
     vol.Optional(CONF_MODE, default=MODE_MONO):
         vol.In([MODE_MONO, MODE_TRI]),
     vol.Optional(CONF_ZONES, default=1):
@@ -157,9 +313,75 @@ PLATFORM_SCHEMA = PLATFORM_SCHEMA.extend({
         vol.All(cv.ensure_list, [vol.In(OWL_CLASSES)]),
     vol.Optional(CONF_COST_ICON, default='mdi:coin'): cv.string,
     vol.Optional(CONF_COST_UNIT_OF_MEASUREMENT): cv.string,
+    vol.Optional(CONF_DECODER, default=DECODER_TREE):
+        vol.In([DECODER_TREE, DECODER_FAST]),
+    vol.Optional(CONF_HISTORY): HISTORY_SCHEMA,
+    vol.Optional(CONF_DIAGNOSTICS): DIAGNOSTICS_SCHEMA,
+    vol.Optional(CONF_STALE_AFTER, default={}):
+        {vol.In(OWL_CLASSES): vol.All(vol.Coerce(int), vol.Range(min=1))},
+    vol.Optional(CONF_LIFETIME_ENERGY, default=False): cv.boolean,
+    vol.Optional(CONF_PERSIST, default=False): cv.boolean,
+    vol.Optional(CONF_CAPTURE): CAPTURE_SCHEMA,
+    vol.Optional(CONF_EXPORTER): EXPORTER_SCHEMA,
+    vol.Optional(CONF_DISCOVERY, default=False): cv.boolean,
+    vol.Optional(CONF_WORKERS, default=0):
+        vol.All(vol.Coerce(int), vol.Range(min=0, max=8)),
+    vol.Optional(CONF_THROTTLE, default={}):
+        {vol.In(OWL_CLASSES + list(SENSOR_TYPES) + list(ENERGY_SENSOR_TYPES)): THROTTLE_SCHEMA},
 })
 
-SOCK_TIMEOUT = 60
+# Counters exposed by OwlData and OwlListener as diagnostics
+COUNTER_ACCEPTED = 'accepted'
+COUNTER_DUPLICATE = 'duplicate'
+COUNTER_STALE = 'stale'
+COUNTER_UNPARSEABLE = 'unparseable'
+COUNTER_TRUNCATED = 'truncated'
+COUNTER_IGNORED = 'ignored'
+COUNTER_BIND_FAILED = 'bind_failed'
+COUNTER_CAPTURED = 'captured'
+COUNTER_CAPTURE_DROPPED = 'capture_dropped'
+COUNTER_THROTTLED = 'throttled'
+COUNTER_QUEUE_DROPPED = 'queue_dropped'
+
+# Histograms kept by OwlData
+HISTOGRAM_PROCESS = 'process'       # whole on_data_received()
+HISTOGRAM_DECODE = 'decode'         # parse and decode of the packet
+HISTOGRAM_UPDATE = 'entity_update'  # OwlIntuitionSensor.update()
+HISTOGRAM_WRITE = 'state_write'     # from packet reception to state written
+
+SERVICE_GET_DIAGNOSTICS = 'get_diagnostics'
+PROFILE_TOP_FUNCTIONS = 25
+
+# Capture files: a magic header, then for each datagram its receive time,
+# source address and port, and length, followed by the datagram itself
+CAPTURE_MAGIC = b'OWLCAP\x01\n'
+CAPTURE_QUEUE_SIZE = 10000
+_CAPTURE_RECORD = struct.Struct('<d4sHI')
+_GZIP_MAGIC = b'\x1f\x8b'
+
+# Metrics exporter: time allowed to a client to send its request
+EXPORTER_TIMEOUT = 5
+EXPORTER_CONTENT_TYPE = b'text/plain; version=0.0.4; charset=utf-8'
+
+# Datagrams waiting for the parsing workers, the oldest ones are dropped
+# when more are queued
+WORKER_QUEUE_SIZE = 1000
+
+# Largest UDP payload over IPv4, and max datagrams read per loop wakeup
+MAX_DATAGRAM_SIZE = 65507
+MAX_DATAGRAMS_PER_READ = 64
+
+# Match the root element of a packet, skipping the XML declaration,
+# and the id of the OWL station and the version in its attributes,
+# quoted either way
+_ROOT_TAG_RE = re.compile(rb'<([A-Za-z_][\w.-]*)([^>]*)>')
+_DEVICE_ID_RE = re.compile(rb'\sid=["\']([^"\']*)["\']')
+_VERSION_RE = re.compile(rb'\sver=["\']([^"\']*)["\']')
+
+# Process-wide registry of the listeners, keyed by binding, and count
+# of the failed binds, which outlive the OwlData of the failed setups
+_LISTENERS = {}
+_BIND_FAILURES = Counter()
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -176,15 +398,60 @@ async def async_setup_platform(
         # Perform a reverse lookup to make sure we listen to the correct IP
         hostname = socket.gethostbyname(socket.getfqdn())
 
-    # initialize the listener for OWL data
-    owldata = OwlData((hostname, config.get(CONF_PORT), config.get(CONF_BROADCAST_ADDRESS), config.get(CONF_BROADCAST_PORT)))
+    diagnostics = config.get(CONF_DIAGNOSTICS) or {}
+
+    # optional recorder of the raw datagrams
+    recorder = None
+    capture = config.get(CONF_CAPTURE)
+    if capture is not None:
+        recorder = OwlRecorder(
+            capture.get(CONF_CAPTURE_PATH) or hass.config.path(f'{DOMAIN}_{slugify(config.get(CONF_NAME))}.owlcap'),
+            capture[CONF_CAPTURE_MAX_SIZE], capture[CONF_CAPTURE_FILES], capture[CONF_CAPTURE_COMPRESS])
+
+    # initialize the listener for OWL data: a single socket is kept open
+    # for the lifetime of the platform and shared by all entities, as well
+    # as by the other platforms listening on the same address and port
+    owldata = OwlData((hostname, config.get(CONF_PORT), config.get(CONF_BROADCAST_ADDRESS), config.get(CONF_BROADCAST_PORT)),
+                      history=config.get(CONF_HISTORY), device_id=config.get(CONF_DEVICE_ID),
+                      monitored=config.get(CONF_MONITORED_CONDITIONS), decoder=config.get(CONF_DECODER),
+                      profile_every=diagnostics.get(CONF_DIAGNOSTICS_PROFILE, 0),
+                      stale_after=config.get(CONF_STALE_AFTER),
+                      lifetime_energy=config.get(CONF_LIFETIME_ENERGY), recorder=recorder,
+                      workers=config.get(CONF_WORKERS))
+    if config.get(CONF_PERSIST):
+        # restore the last known values before any live data can come in
+        await owldata.async_load_snapshots(hass, f'{DOMAIN}.{slugify(config.get(CONF_NAME))}')
+    platforms = hass.data.setdefault(DOMAIN, [])
+    if not hass.services.has_service(DOMAIN, SERVICE_GET_DIAGNOSTICS):
+
+        async def _async_get_diagnostics(call: ServiceCall):
+            """Return the diagnostics of all the OWL platforms, and the
+            failed binds, including the ones of platforms not set up"""
+            return {'platforms': [platform.diagnostics() for platform in platforms],
+                    'bind_failures': [{'binding': list(binding), 'count': count}
+                                      for binding, count in _BIND_FAILURES.items()]}
+
+        hass.services.async_register(DOMAIN, SERVICE_GET_DIAGNOSTICS, _async_get_diagnostics,
+                                     supports_response=SupportsResponse.ONLY)
+    if not await owldata.async_start(hass):
+        raise PlatformNotReady(f"Unable to bind the OWL listener for {hostname}")
+    exporter = config.get(CONF_EXPORTER)
+    if exporter is not None:
+        owldata.exporter = OwlExporter(owldata, exporter[CONF_HOST], exporter[CONF_PORT])
+        if not await owldata.exporter.async_start():
+            owldata.exporter = None
+    platforms.append(owldata)
 
-    # Ideally an async listener loop as follows would be a better solution,
-    # but it crashes HA!
-    #owljob = hass.loop.create_datagram_endpoint(
-    #             lambda: OwlStateUpdater(hass.loop), \
-    #             local_addr=(hostname, config.get(CONF_PORT)))
-    #hass.async_add_job(owljob)
+    # watchdog marking the sensors unavailable when their data go stale
+    stop_watchdog = async_track_time_interval(hass, owldata.async_check_stale, WATCHDOG_INTERVAL)
+
+    async def _async_stop_listener(event):
+        """Close the listener when HA shuts down"""
+        stop_watchdog()
+        owldata.async_stop()
+        platforms.remove(owldata)
+
+    hass.bus.async_listen_once(EVENT_HOMEASSISTANT_STOP, _async_stop_listener)
 
     # initialize cost sensor unit of measurement and icon
     SENSOR_TYPES[SENSOR_ELECTRICITY_COST_TODAY][1] = \
@@ -193,268 +460,1883 @@ async def async_setup_platform(
         config.get(CONF_COST_ICON)
 
     entities = []
+    # In discovery mode, the sensors are only created once their data
+    # show up in the packets, otherwise they are all created upfront
+    eager = not config.get(CONF_DISCOVERY)
+    if not eager:
+        OwlDiscovery(owldata, config.get(CONF_NAME), async_add_entities,
+                     triphase=config.get(CONF_MODE) == MODE_TRI,
+                     lifetime_energy=config.get(CONF_LIFETIME_ENERGY),
+                     throttle=config.get(CONF_THROTTLE)).async_start()
+
     # Iterate through the possible sensors and zones and add if class is monitored
     for sensor in SENSOR_TYPES:
-        if SENSOR_TYPES[sensor][3] in config.get(CONF_MONITORED_CONDITIONS):
+        if eager and SENSOR_TYPES[sensor][3] in config.get(CONF_MONITORED_CONDITIONS):
             for zone in range(config.get(CONF_ZONES)):
-                entities.append(OwlIntuitionSensor(owldata, config.get(CONF_NAME), sensor, zone=zone, zones_count=config.get(CONF_ZONES)))
+                entities.append(OwlIntuitionSensor(owldata, config.get(CONF_NAME), sensor, zone=zone, zones_count=config.get(CONF_ZONES),
+                                                   throttle=config.get(CONF_THROTTLE)))
                 _LOGGER.debug("Adding sensor %s", sensor)
     
     # In case of electricity sensors, handle triphase mode
-    if config.get(CONF_MODE) == MODE_TRI and \
+    if eager and config.get(CONF_MODE) == MODE_TRI and \
        OWLCLASS_ELECTRICITY in config.get(CONF_MONITORED_CONDITIONS):
         for phase in range(1, 4):
             entities.append(OwlIntuitionSensor(owldata, config.get(CONF_NAME),
-                                               SENSOR_ELECTRICITY_POWER, phase=phase))
+                                               SENSOR_ELECTRICITY_POWER, phase=phase,
+                                               throttle=config.get(CONF_THROTTLE)))
             entities.append(OwlIntuitionSensor(owldata, config.get(CONF_NAME),
-                                               SENSOR_ELECTRICITY_ENERGY_TODAY, phase=phase))
-    async_add_entities(entities, True)
+                                               SENSOR_ELECTRICITY_ENERGY_TODAY, phase=phase,
+                                               throttle=config.get(CONF_THROTTLE)))
+
+    # Lifetime energy sensors, restored across restarts
+    if eager and config.get(CONF_LIFETIME_ENERGY):
+        for sensor in ENERGY_SENSOR_TYPES:
+            if ENERGY_SENSOR_TYPES[sensor][3] in config.get(CONF_MONITORED_CONDITIONS):
+                entities.append(OwlEnergySensor(owldata, config.get(CONF_NAME), sensor,
+                                                throttle=config.get(CONF_THROTTLE)))
+        if config.get(CONF_MODE) == MODE_TRI and \
+           OWLCLASS_ELECTRICITY in config.get(CONF_MONITORED_CONDITIONS):
+            for phase in range(1, 4):
+                entities.append(OwlEnergySensor(owldata, config.get(CONF_NAME),
+                                                SENSOR_ELECTRICITY_ENERGY_TOTAL, phase=phase,
+                                                throttle=config.get(CONF_THROTTLE)))
+
+    # Diagnostic sensors about the received packets and their processing
+    if diagnostics.get(CONF_DIAGNOSTICS_SENSORS):
+        for sensor in DIAGNOSTIC_TYPES:
+            if sensor != DIAGNOSTIC_PACKET_AGE:
+                entities.append(OwlDiagnosticSensor(owldata, config.get(CONF_NAME), sensor))
+        for owlclass in config.get(CONF_MONITORED_CONDITIONS):
+            entities.append(OwlDiagnosticSensor(owldata, config.get(CONF_NAME),
+                                                DIAGNOSTIC_PACKET_AGE, owlclass=owlclass))
+    async_add_entities(entities)
+
+
+#
+# Decoders: each datagram is parsed once into a compact snapshot holding
+# the native values exposed by the sensors
+#
+
+@dataclass(slots=True)
+class OwlChannel:
+    """A single electricity clamp (channel or phase)"""
+    power: int
+    energy_today: float
+
+
+@dataclass(slots=True)
+class OwlElectricity:
+    """Decoded electricity packet, for both the legacy and v2 layouts"""
+    device_id: str
+    version: str
+    timestamp: int
+    rssi: int
+    battery: str
+    battery_level: int
+    power: int
+    energy_today: float
+    cost_today: float
+    tariff_price: float
+    channels: tuple
+
+
+@dataclass(slots=True)
+class OwlSolar:
+    """Decoded solar packet"""
+    device_id: str
+    version: str
+    timestamp: int
+    generating: int
+    exporting: int
+    generated_today: float
+    exported_today: float
+
+
+@dataclass(slots=True)
+class OwlZone:
+    """A single zone of the multi-zone classes (heating, hot water, relays)"""
+    zone_id: str
+    rssi: int
+    battery: str
+    battery_level: float
+    current: float
+    required: float
+    ambient: float
+    state: str
+
+
+@dataclass(slots=True)
+class OwlZones:
+    """Decoded heating, hot water or relays packet"""
+    device_id: str
+    version: str
+    timestamp: int
+    zones: tuple
+
+    def zone(self, index):
+        """Return the requested zone, falling back to the first one"""
+        if index < len(self.zones):
+            return self.zones[index]
+        return self.zones[0] if self.zones else None
+
+    def zone_by_id(self, zone_id):
+        """Return the zone with the given id, or None if not reported"""
+        for zone in self.zones:
+            if zone.zone_id == zone_id:
+                return zone
+        return None
+
+
+def _battery_state_pct(level):
+    """Battery state from a level in %, as reported by electricity"""
+    if level > 90:
+        return 'High'
+    if level > 30:
+        return 'Medium'
+    if level > 10:
+        return 'Low'
+    return 'Very Low'
+
+
+def _battery_state_mv(level):
+    """Battery state from a level in mV, as reported by the zones"""
+    # 2670mV = 66%
+    # 2780mV = 76%
+    if level > 2900:
+        return 'High'
+    if level > 2750:
+        return 'Medium'
+    if level > 2600:
+        return 'Low'
+    return 'Very Low'
+
+
+def _make_electricity(device_id, xml_ver, timestamp, rssi, battery, chans, watts, wh, cost, price):
+    """Build an electricity snapshot out of the raw values (str or bytes)
+    extracted from the packet; chans is a sequence of (curr, day)"""
+    batt_lvl = int(battery[:-1])
+    channels = tuple(OwlChannel(int(float(curr)), round(float(day)/1000, 2))
+                     for curr, day in chans)
+    # xml_ver undefined for older version, where no totals nor cost
+    # are reported
+    if xml_ver is None:
+        power = channels[0].power
+        energy_today = channels[0].energy_today
+        cost_today = 0
+        tariff_price = None
+    else:
+        power = int(float(watts))
+        energy_today = round(float(wh)/1000, 2)
+        # the measure comes in cent. of the configured currency
+        cost_today = round(float(cost)/100, 3)
+        tariff_price = float(price) if price is not None else None
+    return OwlElectricity(
+        device_id=device_id,
+        version=xml_ver,
+        timestamp=int(timestamp),
+        rssi=int(rssi),
+        battery=_battery_state_pct(batt_lvl),
+        battery_level=batt_lvl,
+        power=power,
+        energy_today=energy_today,
+        cost_today=cost_today,
+        tariff_price=tariff_price,
+        channels=channels)
+
+
+def _make_solar(device_id, xml_ver, timestamp, generating, exporting, generated, exported):
+    """Build a solar snapshot out of the raw values extracted from the packet"""
+    return OwlSolar(
+        device_id=device_id,
+        version=xml_ver,
+        timestamp=int(timestamp),
+        generating=int(float(generating)),
+        exporting=int(float(exporting)),
+        generated_today=round(float(generated)/1000, 2),
+        exported_today=round(float(exported)/1000, 2))
+
+
+def _make_zone(zone_id, xml_ver, states, rssi, battery, state, current, required, ambient):
+    """Build a zone snapshot out of the raw values extracted from the
+    packet, any of which may be None if not reported"""
+    batt_lvl = int(battery) if battery is not None else None
+    return OwlZone(
+        zone_id=zone_id,
+        rssi=int(rssi) if rssi is not None else None,
+        battery=_battery_state_mv(batt_lvl) if batt_lvl is not None else None,
+        battery_level=round(batt_lvl/1000, 2) if batt_lvl is not None else None,
+        current=round(float(current), 1) if current is not None else None,
+        required=float(required) if required is not None else None,
+        ambient=float(ambient) if ambient is not None else None,
+        # Heating and hot water states reported in version 2 and up
+        state=states[int(state)] if xml_ver is not None and states is not None and state is not None else None)
+
+
+def _decode_electricity(xml):
+    """Decode an electricity packet"""
+    xml_ver = xml.attrib.get('ver')
+    # xml_ver undefined for older version, where the channels are
+    # direct children of the root element
+    if xml_ver is None:
+        chans = xml.findall('chan')
+    else:
+        chans = xml.find('channels').findall('chan')
+    return _make_electricity(
+        xml.attrib.get('id'), xml_ver, xml.findtext('timestamp', '0'),
+        xml.find('signal').attrib['rssi'], xml.find('battery').attrib['level'],
+        [(chan.findtext('curr'), chan.findtext('day')) for chan in chans],
+        xml.findtext('property/current/watts'), xml.findtext('property/day/wh'),
+        xml.findtext('property/day/cost'), xml.findtext('property/tariff/curr_price'))
+
+
+def _decode_solar(xml):
+    """Decode a solar packet"""
+    return _make_solar(
+        xml.attrib.get('id'), xml.attrib.get('ver'), xml.findtext('timestamp', '0'),
+        xml.findtext('current/generating'), xml.findtext('current/exporting'),
+        xml.findtext('day/generated'), xml.findtext('day/exported'))
+
+
+def _decode_zone(zone, xml_ver, states):
+    """Decode a single zone of a multi-zone packet"""
+    signal = zone.find('signal')
+    battery = zone.find('battery')
+    temperature = zone.find('temperature')
+    return _make_zone(
+        zone.attrib.get('id'), xml_ver, states,
+        signal.attrib['rssi'] if signal is not None else None,
+        battery.attrib['level'] if battery is not None else None,
+        temperature.attrib.get('state') if temperature is not None else None,
+        zone.findtext('temperature/current'), zone.findtext('temperature/required'),
+        zone.findtext('temperature/ambient'))
+
+
+def _decode_zones(xml):
+    """Decode a heating, hot water or relays packet"""
+    xml_ver = xml.attrib.get('ver')
+    states = ZONE_STATES.get(xml.tag)
+    zones = xml.find('zones')
+    return OwlZones(
+        device_id=xml.attrib.get('id'),
+        version=xml_ver,
+        timestamp=int(xml.findtext('timestamp', '0')),
+        zones=tuple(_decode_zone(zone, xml_ver, states)
+                    for zone in (zones if zones is not None else ())))
+
+
+OWL_DECODERS = {
+    OWLCLASS_ELECTRICITY: _decode_electricity,
+    OWLCLASS_SOLAR: _decode_solar,
+    OWLCLASS_HOTWATER: _decode_zones,
+    OWLCLASS_HEATING: _decode_zones,
+    OWLCLASS_RELAYS: _decode_zones,
+}
+
+#
+# Fast decoders: for the known layouts, the few leaves used by the sensors
+# are extracted with precompiled patterns straight from the raw packet,
+# without building any element tree. Anything unexpected makes them fail,
+# and the full tree decoders above are used instead.
+#
+
+_FAST_TIMESTAMP = re.compile(rb'<timestamp>([^<]*)</timestamp>')
+_FAST_RSSI = re.compile(rb'<signal\s[^>]*?rssi=["\']([^"\']*)["\']')
+_FAST_BATTERY = re.compile(rb'<battery\s[^>]*?level=["\']([^"\']*)["\']')
+_FAST_CHAN = re.compile(rb'<chan(?:\s[^>]*)?>\s*<curr[^>]*>([^<]*)</curr>\s*<day[^>]*>([^<]*)</day>')
+_FAST_ANY_CHAN = re.compile(rb'<chan[\s/>]')
+_FAST_WATTS = re.compile(rb'<current>\s*<watts>([^<]*)</watts>')
+_FAST_DAY = re.compile(rb'<day>\s*<wh>([^<]*)</wh>\s*<cost>([^<]*)</cost>')
+_FAST_PRICE = re.compile(rb'<curr_price>([^<]*)</curr_price>')
+_FAST_GENERATING = re.compile(rb'<generating[^>]*>([^<]*)</generating>')
+_FAST_EXPORTING = re.compile(rb'<exporting[^>]*>([^<]*)</exporting>')
+_FAST_GENERATED = re.compile(rb'<generated[^>]*>([^<]*)</generated>')
+_FAST_EXPORTED = re.compile(rb'<exported[^>]*>([^<]*)</exported>')
+_FAST_ZONE = re.compile(rb'<zone\s[^>]*?id=["\']([^"\']*)["\'][^>]*>(.*?)</zone>', re.DOTALL)
+_FAST_ANY_ZONE = re.compile(rb'<zone[\s/>]')
+_FAST_STATE = re.compile(rb'<temperature\s[^>]*?state=["\']([^"\']*)["\']')
+_FAST_CURRENT = re.compile(rb'<current>([^<]*)</current>')
+_FAST_REQUIRED = re.compile(rb'<required>([^<]*)</required>')
+_FAST_AMBIENT = re.compile(rb'<ambient>([^<]*)</ambient>')
+
+
+def _fast_group(pattern, xmldata, pos=0, endpos=sys.maxsize):
+    """Return the first group matched by the pattern, or None"""
+    match = pattern.search(xmldata, pos, endpos)
+    return match.group(1) if match is not None else None
+
+
+def _fast_electricity(xmldata, owlclass, device_id, xml_ver):
+    """Decode an electricity packet of a known layout"""
+    if xml_ver is None:
+        watts = wh = cost = price = None
+    else:
+        watts = _FAST_WATTS.search(xmldata).group(1)
+        wh, cost = _FAST_DAY.search(xmldata).groups()
+        price = _fast_group(_FAST_PRICE, xmldata)
+    chans = _FAST_CHAN.findall(xmldata)
+    if len(chans) != len(_FAST_ANY_CHAN.findall(xmldata)):
+        # a skipped channel would shift all the next phases
+        raise ValueError("channels of an unknown layout")
+    return _make_electricity(
+        device_id, xml_ver, _fast_group(_FAST_TIMESTAMP, xmldata) or 0,
+        _FAST_RSSI.search(xmldata).group(1), _FAST_BATTERY.search(xmldata).group(1),
+        chans, watts, wh, cost, price)
+
+
+def _fast_solar(xmldata, owlclass, device_id, xml_ver):
+    """Decode a solar packet of a known layout"""
+    return _make_solar(
+        device_id, xml_ver, _fast_group(_FAST_TIMESTAMP, xmldata) or 0,
+        _FAST_GENERATING.search(xmldata).group(1), _FAST_EXPORTING.search(xmldata).group(1),
+        _FAST_GENERATED.search(xmldata).group(1), _FAST_EXPORTED.search(xmldata).group(1))
+
+
+def _fast_zones(xmldata, owlclass, device_id, xml_ver):
+    """Decode a heating, hot water or relays packet of a known layout"""
+    states = ZONE_STATES.get(owlclass)
+    zones = []
+    for zone in _FAST_ZONE.finditer(xmldata):
+        start, end = zone.span(2)
+        zones.append(_make_zone(
+            zone.group(1).decode('ascii'), xml_ver, states,
+            _fast_group(_FAST_RSSI, xmldata, start, end),
+            _fast_group(_FAST_BATTERY, xmldata, start, end),
+            _fast_group(_FAST_STATE, xmldata, start, end),
+            _fast_group(_FAST_CURRENT, xmldata, start, end),
+            _fast_group(_FAST_REQUIRED, xmldata, start, end),
+            _fast_group(_FAST_AMBIENT, xmldata, start, end)))
+    if not zones and _FAST_ANY_ZONE.search(xmldata):
+        raise ValueError("zones of an unknown layout")
+    return OwlZones(
+        device_id=device_id,
+        version=xml_ver,
+        timestamp=int(_fast_group(_FAST_TIMESTAMP, xmldata) or 0),
+        zones=tuple(zones))
+
+
+# Known layouts, keyed by root tag and major version (None for legacy)
+FAST_DECODERS = {
+    (OWLCLASS_ELECTRICITY, None): _fast_electricity,
+    (OWLCLASS_ELECTRICITY, '2'): _fast_electricity,
+    (OWLCLASS_SOLAR, None): _fast_solar,
+    (OWLCLASS_SOLAR, '2'): _fast_solar,
+    (OWLCLASS_HOTWATER, None): _fast_zones,
+    (OWLCLASS_HOTWATER, '2'): _fast_zones,
+    (OWLCLASS_HEATING, None): _fast_zones,
+    (OWLCLASS_HEATING, '2'): _fast_zones,
+    (OWLCLASS_RELAYS, None): _fast_zones,
+    (OWLCLASS_RELAYS, '2'): _fast_zones,
+}
+
+
+ZONED_CLASSES = (OWLCLASS_HOTWATER, OWLCLASS_HEATING, OWLCLASS_RELAYS)
+
+# How each sensor type gets its native value out of a snapshot: the
+# arguments are the snapshot (or the relevant zone) and the phase
+SENSOR_VALUES = {
+    SENSOR_ELECTRICITY_BATTERY: lambda s, p: s.battery,
+    SENSOR_ELECTRICITY_BATTERY_LVL: lambda s, p: s.battery_level,
+    SENSOR_ELECTRICITY_RADIO: lambda s, p: s.rssi,
+    SENSOR_ELECTRICITY_POWER: lambda s, p: s.channels[p-1].power if p else s.power,
+    SENSOR_ELECTRICITY_ENERGY_TODAY: lambda s, p: s.channels[p-1].energy_today if p else s.energy_today,
+    SENSOR_ELECTRICITY_COST_TODAY: lambda s, p: s.cost_today,
+    SENSOR_SOLAR_GPOWER: lambda s, p: s.generating,
+    SENSOR_SOLAR_GENERGY_TODAY: lambda s, p: s.generated_today,
+    SENSOR_SOLAR_EPOWER: lambda s, p: s.exporting,
+    SENSOR_SOLAR_EENERGY_TODAY: lambda s, p: s.exported_today,
+    SENSOR_HOTWATER_BATTERY: lambda s, p: s.battery,
+    SENSOR_HOTWATER_BATTERY_LVL: lambda s, p: s.battery_level,
+    SENSOR_HOTWATER_RADIO: lambda s, p: s.rssi,
+    SENSOR_HOTWATER_CURRENT: lambda s, p: s.current,
+    SENSOR_HOTWATER_REQUIRED: lambda s, p: s.required,
+    SENSOR_HOTWATER_AMBIENT: lambda s, p: s.ambient,
+    SENSOR_HOTWATER_STATE: lambda s, p: s.state,
+    SENSOR_HEATING_BATTERY: lambda s, p: s.battery,
+    SENSOR_HEATING_BATTERY_LVL: lambda s, p: s.battery_level,
+    SENSOR_HEATING_RADIO: lambda s, p: s.rssi,
+    SENSOR_HEATING_CURRENT: lambda s, p: s.current,
+    SENSOR_HEATING_REQUIRED: lambda s, p: s.required,
+    SENSOR_HEATING_STATE: lambda s, p: s.state,
+    SENSOR_RELAYS_RADIO: lambda s, p: s.rssi,
+}
+
+
+def _restore_snapshot(owlclass, values):
+    """Rebuild a snapshot out of its saved values, or return None if
+    the class is not known"""
+    if owlclass == OWLCLASS_ELECTRICITY:
+        return OwlElectricity(**dict(values, channels=tuple(
+            OwlChannel(**channel) for channel in values['channels'])))
+    if owlclass == OWLCLASS_SOLAR:
+        return OwlSolar(**values)
+    if owlclass in ZONED_CLASSES:
+        return OwlZones(**dict(values, zones=tuple(
+            OwlZone(**zone) for zone in values['zones'])))
+    return None
+
+
+#
+# History: bounded time series of the most relevant readings, with
+# aggregates over sliding windows
+#
+
+class _OwlWindow:
+    """Running aggregates of a sliding time window over an OwlSeries"""
+    __slots__ = ('duration', 'start', 'total', 'mins', 'maxs')
+
+    def __init__(self, duration):
+        self.duration = duration
+        self.start = 0          # absolute index of the oldest sample in the window
+        self.total = 0.0
+        self.mins = deque()     # indexes of the increasing candidates for the min
+        self.maxs = deque()     # indexes of the decreasing candidates for the max
+
+
+class OwlSeries:
+    """Fixed-capacity ring buffer of timestamped samples, which maintains
+    min, max and mean over its windows in O(1) amortized time per sample.
+    Percentiles are computed on demand from the samples of the window."""
+    __slots__ = ('_capacity', '_times', '_values', '_count', '_windows')
+
+    def __init__(self, capacity, windows):
+        """Preallocate the buffers: memory is bounded by the capacity"""
+        self._capacity = capacity
+        self._times = array('d', bytes(8 * capacity))
+        self._values = array('d', bytes(8 * capacity))
+        self._count = 0
+        self._windows = {duration: _OwlWindow(duration) for duration in windows}
+
+    def _evict(self, window, oldest, limit):
+        """Drop from the window the samples older than the given time or
+        whose index is below the given limit"""
+        times, values, capacity = self._times, self._values, self._capacity
+        while window.start < self._count and \
+              (window.start < limit or times[window.start % capacity] < oldest):
+            window.total -= values[window.start % capacity]
+            if window.mins and window.mins[0] == window.start:
+                window.mins.popleft()
+            if window.maxs and window.maxs[0] == window.start:
+                window.maxs.popleft()
+            window.start += 1
+
+    def push(self, when, value):
+        """Append a sample, overwriting the oldest one when full"""
+        index = self._count
+        for window in self._windows.values():
+            # the slot about to be overwritten must leave the window first
+            self._evict(window, float('-inf'), index + 1 - self._capacity)
+        self._times[index % self._capacity] = when
+        self._values[index % self._capacity] = value
+        self._count += 1
+        values, capacity = self._values, self._capacity
+        for window in self._windows.values():
+            window.total += value
+            while window.mins and values[window.mins[-1] % capacity] >= value:
+                window.mins.pop()
+            window.mins.append(index)
+            while window.maxs and values[window.maxs[-1] % capacity] <= value:
+                window.maxs.pop()
+            window.maxs.append(index)
+            self._evict(window, when - window.duration, 0)
+
+    def stats(self, duration, now):
+        """Return (min, max, mean, count) over the given window, or None
+        if the window holds no samples"""
+        window = self._windows[duration]
+        self._evict(window, now - duration, 0)
+        count = self._count - window.start
+        if not count:
+            return None
+        return (self._values[window.mins[0] % self._capacity],
+                self._values[window.maxs[0] % self._capacity],
+                window.total / count, count)
+
+    def percentiles(self, duration, percents, now):
+        """Return the given percentiles (nearest rank) over the window,
+        sorting it once for all of them: O(n log n) in its samples"""
+        window = self._windows[duration]
+        self._evict(window, now - duration, 0)
+        samples = sorted(self._values[index % self._capacity]
+                         for index in range(window.start, self._count))
+        if not samples:
+            return [None] * len(percents)
+        return [samples[max(int(-(-percent * len(samples) // 100)), 1) - 1] for percent in percents]
+
+
+def _history_keys(owlclass, snapshot, sensor_type):
+    """Yield the (key, value) pairs to record for the given sensor type:
+    keys are (sensor_type, phase, zone id) as in OwlIntuitionSensor"""
+    value_of = SENSOR_VALUES[sensor_type]
+    if owlclass in ZONED_CLASSES:
+        for zone_snapshot in snapshot.zones:
+            yield (sensor_type, 0, zone_snapshot.zone_id), value_of(zone_snapshot, 0)
+    elif owlclass == OWLCLASS_ELECTRICITY:
+        for phase in range(len(snapshot.channels) + 1):
+            yield (sensor_type, phase, 0), value_of(snapshot, phase)
+    else:
+        yield (sensor_type, 0, 0), value_of(snapshot, 0)
+
+
+HISTORY_SENSORS = {
+    OWLCLASS_ELECTRICITY: (SENSOR_ELECTRICITY_POWER,),
+    OWLCLASS_SOLAR: (SENSOR_SOLAR_GPOWER, SENSOR_SOLAR_EPOWER),
+    OWLCLASS_HOTWATER: (SENSOR_HOTWATER_CURRENT,),
+    OWLCLASS_HEATING: (SENSOR_HEATING_CURRENT,),
+}
+
+
+#
+# Energy: lifetime totals integrated locally from the power readings
+#
+
+class OwlEnergy:
+    """Lifetime energy totals, in Wh, integrated from the power readings
+    with the trapezoidal rule over the timestamps of the packets.
+    Unlike the daily totals reported by the station they have a 1 Wh
+    resolution and never reset. Totals are keyed as the history, by the
+    (sensor_type, phase, zone) of the power reading they integrate."""
+    __slots__ = ('totals', '_last', '_max_gap')
+
+    def __init__(self, max_gap):
+        self.totals = {}
+        self._last = {}
+        self._max_gap = max_gap     # per class, longer gaps are not integrated
+
+    def integrate(self, owlclass, snapshot):
+        """Add the energy since the previous packet of the class"""
+        # legacy packets carry no timestamp, use the local clock instead
+        when = snapshot.timestamp or time.time()
+        max_gap = self._max_gap[owlclass]
+        for sensor_type in ENERGY_SENSORS.get(owlclass, ()):
+            for key, power in _history_keys(owlclass, snapshot, sensor_type):
+                if power is None:
+                    continue
+                last = self._last.get(key)
+                self._last[key] = (when, power)
+                total = self.totals.setdefault(key, 0.0)
+                if last is not None and 0 < when - last[0] <= max_gap:
+                    self.totals[key] = total + (last[1] + power) * (when - last[0]) / 7200
+
+    def restore(self, key, total):
+        """Resume from a previously saved total, unless already past it"""
+        if total > self.totals.get(key, 0.0):
+            self.totals[key] = total
+
+
+ENERGY_SENSORS = {
+    OWLCLASS_ELECTRICITY: (SENSOR_ELECTRICITY_POWER,),
+    OWLCLASS_SOLAR: (SENSOR_SOLAR_GPOWER, SENSOR_SOLAR_EPOWER),
+}
+
+
+#
+# Diagnostics: latency histograms and profiling of the hot path
+#
+
+class OwlHistogram:
+    """Histogram of durations over fixed, roughly logarithmic buckets"""
+    __slots__ = ('counts', 'count', 'total', 'maximum')
+
+    # upper bounds of the buckets, in microseconds
+    BOUNDS = (10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 20000, 50000, 100000)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+
+    def record(self, seconds):
+        """Add a duration, given in seconds"""
+        micros = seconds * 1e6
+        self.counts[bisect_left(self.BOUNDS, micros)] += 1
+        self.count += 1
+        self.total += micros
+        if micros > self.maximum:
+            self.maximum = micros
+
+    def percentile(self, percent):
+        """Return the upper bound (in us) of the bucket holding the given
+        percentile, capped to the max seen so far"""
+        if not self.count:
+            return None
+        rank = percent * self.count / 100
+        seen = 0
+        for bound, count in zip(self.BOUNDS, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, round(self.maximum, 1))
+        return round(self.maximum, 1)
+
+    def as_dict(self):
+        """Summary suitable for the diagnostics"""
+        return {
+            'count': self.count,
+            'mean_us': round(self.total / self.count, 1) if self.count else None,
+            'p50_us': self.percentile(50),
+            'p95_us': self.percentile(95),
+            'max_us': round(self.maximum, 1),
+            'buckets': {f'<={bound}us': count
+                        for bound, count in zip(self.BOUNDS, self.counts) if count},
+            'overflow': self.counts[-1],
+        }
+
+
+#
+# Capture: raw datagrams recorded to rotating binary logs, to be replayed
+#
+
+class OwlRecorder:
+    """Recorder of the raw datagrams, with their receive time and source,
+    to a size-bounded set of rotating capture files: the current one at
+    path, and the older ones at path.1, path.2, and so on.
+    Datagrams are copied and queued in the event loop, and written by a
+    background thread, so that the loop never waits for the disk. When
+    the queue is full they are dropped, and counted."""
+
+    def __init__(self, path, max_size, files, compress):
+        """Prepare the queue, the writer is started with the first datagram"""
+        self.path = path
+        self._max_size = max_size
+        self._files = files
+        self._compress = compress
+        self._queue = queue.Queue(CAPTURE_QUEUE_SIZE)
+        self._stopping = threading.Event()
+        self._thread = None
+        self.counters = Counter()
+
+    def record(self, datagram, source=None):
+        """Queue a datagram for writing"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name=f'{DOMAIN}_recorder', daemon=True)
+            self._thread.start()
+        host, port = source if source is not None else ('0.0.0.0', 0)
+        try:
+            self._queue.put_nowait(_CAPTURE_RECORD.pack(
+                time.time(), socket.inet_aton(host), port, len(datagram)) + datagram)
+        except queue.Full:
+            self.counters[COUNTER_CAPTURE_DROPPED] += 1
+
+    def stop(self):
+        """Let the writer flush the queued datagrams, and close the file"""
+        self._stopping.set()
+        try:
+            self._queue.put_nowait(None)
+        except queue.Full:
+            pass
+
+    def _open(self):
+        """Start a new capture file, rotating the existing ones"""
+        if os.path.exists(self.path) and os.path.getsize(self.path):
+            for index in range(self._files - 1, 0, -1):
+                older = f'{self.path}.{index - 1}' if index > 1 else self.path
+                if os.path.exists(older):
+                    os.replace(older, f'{self.path}.{index}')
+        raw = open(self.path, 'wb')
+        out = gzip.GzipFile(fileobj=raw, mode='wb') if self._compress else raw
+        out.write(CAPTURE_MAGIC)
+        return raw, out
+
+    def _run(self):
+        """Writer thread: append the queued records, flushing them when
+        the queue is empty, and rotate the files on the size limit"""
+        raw = out = None
+        # bytes written since the last flush: the compressor buffers them,
+        # so the file size is only known once flushed
+        unflushed = 0
+        try:
+            raw, out = self._open()
+            while True:
+                try:
+                    record = self._queue.get(timeout=1)
+                except queue.Empty:
+                    if self._stopping.is_set():
+                        break
+                    continue
+                if record is None:
+                    break
+                out.write(record)
+                unflushed += len(record)
+                self.counters[COUNTER_CAPTURED] += 1
+                if self._queue.empty() or \
+                   (self._compress and raw.tell() + unflushed >= self._max_size):
+                    out.flush()
+                    unflushed = 0
+                if raw.tell() >= self._max_size:
+                    out.close()
+                    raw.close()
+                    raw, out = self._open()
+        except OSError as err:
+            _LOGGER.error("Unable to write the capture %s: %s", self.path, err)
+        finally:
+            if out is not None:
+                out.close()
+                raw.close()
+
+
+def read_capture(path):
+    """Yield the (receive time, (host, port), datagram) records of a
+    capture file, compressed or not. A last record truncated by a crash
+    is ignored."""
+    with open(path, 'rb') as raw:
+        compressed = raw.read(len(_GZIP_MAGIC)) == _GZIP_MAGIC
+    with (gzip.open if compressed else open)(path, 'rb') as f:
+        if f.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise ValueError(f"{path} is not an OWL capture file")
+        try:
+            while True:
+                header = f.read(_CAPTURE_RECORD.size)
+                if len(header) < _CAPTURE_RECORD.size:
+                    return
+                when, host, port, length = _CAPTURE_RECORD.unpack(header)
+                datagram = f.read(length)
+                if len(datagram) < length:
+                    return
+                yield when, (socket.inet_ntoa(host), port), datagram
+        except EOFError:
+            return
+
+
+def replay_capture(owldata, path, realtime=False):
+    """Feed the datagrams of a capture file to an OwlData, either as fast
+    as possible or paced as they were received: the latter sleeps, hence
+    it must not be called from the event loop.
+    Returns the number of datagrams replayed."""
+    count = 0
+    origin = None
+    for when, source, datagram in read_capture(path):
+        if realtime:
+            if origin is None:
+                origin = (when, time.monotonic())
+            pause = when - origin[0] - (time.monotonic() - origin[1])
+            if pause > 0:
+                time.sleep(pause)
+        owldata.on_data_received(datagram, source)
+        count += 1
+    return count
+
+
+def _root_of(xmldata):
+    """Return the root tag, the station's device id and the version of
+    a raw packet, without parsing it. They are None if not found."""
+    root = _ROOT_TAG_RE.search(xmldata)
+    if root is None:
+        return None, None, None
+    device_id = _DEVICE_ID_RE.search(root.group(2))
+    xml_ver = _VERSION_RE.search(root.group(2))
+    # stray datagrams may hold anything in the attributes
+    return (root.group(1).decode('ascii'),
+            device_id.group(1).decode('ascii', 'replace') if device_id else None,
+            xml_ver.group(1).decode('ascii', 'replace') if xml_ver else None)
 
 
 class OwlData:
-    """A class to retrieve data from the OWL station via UDP.
-    The callback method can be used by an event loop in a thread-safe way
-    when new data is received. However, async loops crash HA!
-    The update() method is instead fully synchronous.
+    """A class to retrieve data from an OWL station via UDP.
+    Datagrams are received by an OwlListener shared by all the OwlData
+    with the same binding, which keeps its socket open until the last
+    of them is stopped, and routes the packets of each station to the
+    OwlData pinned to its device id, if any. The latest packet of each
+    class is cached so that entities can read it without doing any I/O.
+    Entities subscribe to the OWL class they depend on and get notified
+    as soon as a packet of that class is received.
+    Packets of classes not monitored are dropped as soon as their root
+    tag is known, and with the fast decoder the monitored ones are decoded
+    without building an element tree whenever their layout is known.
+    If a history configuration is given, the most relevant readings are
+    also kept in bounded time series, see OwlSeries, and with lifetime
+    energy enabled the power readings are integrated, see OwlEnergy.
+    Snapshots can be persisted, to be restored when HA restarts: they are
+    saved in a batch at most once per SNAPSHOTS_SAVE_DELAY.
+    With a recorder, all the datagrams received are captured as they are,
+    and with an exporter the snapshots are served as metrics.
+    With workers, the packets are parsed and decoded by a pool of threads
+    instead of the event loop, which only filters them beforehand, and
+    stores the snapshots and notifies the entities afterwards, by batch.
     """
 
-    def __init__(self, binding):
+    def __init__(self, binding, history=None, device_id=None, monitored=None, decoder=DECODER_TREE,
+                 profile_every=0, stale_after=None, lifetime_energy=False, recorder=None, workers=0):
         """Prepare an empty dictionary"""
         self.data = {}
         self._binding = binding
+        self.monitored = frozenset(monitored) if monitored is not None else None
+        self._fast = decoder == DECODER_FAST
+        self.history_config = history
+        self.history = {}
+        self._subscribers = {}
+        self._digests = {}
+        self.counters = Counter()
+        self.device_id = device_id.upper() if device_id else None
+        self._device_ids = set()
+        self._listener = None
+        self.received = Counter()
+        self.last_seen = {}
+        self.zone_last_seen = {}
+        self.stale = set()
+        self.stale_after = dict(DEFAULT_STALE_AFTER, **(stale_after or {}))
+        self.energy = OwlEnergy(self.stale_after) if lifetime_energy else None
+        self.restored = set()
+        self._store = None
+        self._save_pending = False
+        self.recorder = recorder
+        self.exporter = None
+        self.received_at = None
+        self.packet_class = None
+        self.histograms = {name: OwlHistogram() for name in
+                           (HISTOGRAM_PROCESS, HISTOGRAM_DECODE, HISTOGRAM_UPDATE, HISTOGRAM_WRITE)}
+        self._profile_every = profile_every
+        self._profiler = cProfile.Profile() if profile_every else None
+        self._packets = 0
+        self._workers = workers
+        self._threads = []
+        self._stopping = None
+        self._queue = deque(maxlen=WORKER_QUEUE_SIZE)
+        self._queue_cond = threading.Condition()
+        self.queue_high_water = 0
+        self._ready = []
+        self._ready_lock = threading.Lock()
+        self._apply_scheduled = False
+        self._loop = None
+        self._queued = 0
+        self._applied = 0
 
-    def update(self):
-        """Retrieve the latest data by listening to the periodic UDP message"""
-        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP) as sock:
-            sock.settimeout(SOCK_TIMEOUT)
-            if self._binding[1]:
-                try:
-                    _LOGGER.debug("Binding to: %s on port: %s", self._binding[0], self._binding[1])
-                    sock.bind((self._binding[0], self._binding[1]))
-                except socket.error as se:
-                    _LOGGER.error("Unable to bind to %s on %s error: %s", self._binding[0], self._binding[1], se)
-                    return
-            else:
-                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-                try:
-                    _LOGGER.debug("Multicast Binding to %s on port %s", self._binding[2], self._binding[3])
-                    sock.bind((self._binding[2], self._binding[3]))
-                except socket.error as se:
-                    _LOGGER.error("Unable to bind to %s on %s error: %s", self._binding[2], self._binding[3], se)
-                    return
-                sock.setsockopt(socket.SOL_IP, socket.IP_MULTICAST_IF, socket.inet_aton(self._binding[0]))
-                sock.setsockopt(socket.SOL_IP, socket.IP_ADD_MEMBERSHIP, socket.inet_aton(self._binding[2]) + socket.inet_aton(self._binding[0]))
+    async def async_start(self, hass):
+        """Attach to the shared listener for our binding, starting it
+        if this is the first OwlData using it"""
+        if self._listener is not None:
+            return True
+        listener = _LISTENERS.get(self._binding)
+        if listener is None:
+            listener = OwlListener(self._binding)
+            if not await listener.async_start(hass):
+                _BIND_FAILURES[self._binding] += 1
+                return False
+            _LISTENERS[self._binding] = listener
+        listener.attach(self)
+        self._listener = listener
+        self.start_workers(hass.loop)
+        return True
+
+    def async_stop(self):
+        """Detach from the shared listener, which is closed together with
+        its socket when no other OwlData uses it, and stop the recorder
+        and the exporter"""
+        if self.recorder is not None:
+            self.recorder.stop()
+        if self.exporter is not None:
+            self.exporter.async_stop()
+        self.stop_workers()
+        if self._listener is None:
+            return
+        if not self._listener.detach(self):
+            self._listener.async_stop()
+            del _LISTENERS[self._binding]
+        self._listener = None
 
-            readable, _, _ = select([sock], [], [], SOCK_TIMEOUT)
-            if not readable:
-                if self._binding[1]:
-                    _LOGGER.warning(
-                        "Timeout (%s seconds) waiting for data on port %s",
-                        SOCK_TIMEOUT, self._binding[1])
-                else:
-                    _LOGGER.warning(
-                        "Timeout (%s seconds) waiting for multicast data on group address %s port %s",
-                        SOCK_TIMEOUT, self._binding[2], self._binding[3])
+    def on_data_received(self, xmldata, source=None):
+        """Callback when new data is received from the source address:
+        decode it once and store the resulting snapshot in the dict.
+        Raw bytes, views of a receive buffer (valid only for the duration
+        of the call) and already decoded strings are accepted.
+        Packets identical to the last one of the same type, or not newer
+        than it, are dropped without notifying the entities.
+        One packet every profile_every is run under the profiler."""
+        self.received_at = start = time.perf_counter()
+        self._packets += 1
+        if self.recorder is not None:
+            self.recorder.record(xmldata.encode('utf-8') if isinstance(xmldata, str) else xmldata, source)
+        if self._profiler is not None and self._packets % self._profile_every == 0:
+            self._profiler.enable()
+            try:
+                self._process(xmldata)
+            finally:
+                self._profiler.disable()
+        else:
+            self._process(xmldata)
+        self.histograms[HISTOGRAM_PROCESS].record(time.perf_counter() - start)
+
+    def _process(self, xmldata):
+        """Decode and store a packet, and notify the entities, or queue it
+        for the workers once filtered"""
+        if isinstance(xmldata, str):
+            xmldata = xmldata.encode('utf-8')
+        root, device_id, xml_ver = _root_of(xmldata)
+        if root is not None:
+            self.received[root] += 1
+            if self.monitored is not None and root not in self.monitored:
+                # not worth parsing the body of packets nobody is interested in
+                self.counters[COUNTER_IGNORED] += 1
+                return
+            if device_id not in self._device_ids:
+                self._device_ids.add(device_id)
+                if self.device_id is None and len(self._device_ids) == 2:
+                    _LOGGER.warning("Data received from several OWL stations (%s): "
+                                    "configure a device_id to tell them apart",
+                                    ', '.join(sorted(str(d) for d in self._device_ids)))
+            digest = (len(xmldata), zlib.crc32(xmldata))
+            if self._digests.get(root) == digest:
+                self.counters[COUNTER_DUPLICATE] += 1
+                # still a sign of life, e.g. legacy packets of steady readings
+                last = self.data.get(root)
+                if last is not None:
+                    stale = len(self.stale)
+                    self._seen(root, last)
+                    if len(self.stale) != stale:
+                        if self.exporter is not None:
+                            self.exporter.invalidate()
+                        self._notify(root)
                 return
+            self._digests[root] = digest
+        if self._threads:
+            self._enqueue((bytes(xmldata), root, device_id, xml_ver, self.received_at))
+            return
+        root, snapshot, elapsed, unparseable = self._decode(xmldata, root, device_id, xml_ver)
+        if self._decoded(root, snapshot, elapsed, unparseable):
+            self._notify_packet(root)
+
+    def _decode(self, xmldata, root, device_id, xml_ver):
+        """Decode a packet, with the fast decoder if possible. Returns the
+        OWL class, the snapshot (None if not decoded), the time taken and
+        whether the packet is invalid. It only reads the OwlData, so that
+        it can be run by the workers."""
+        start = time.perf_counter()
+        snapshot = None
+        if self._fast:
+            fast_decoder = FAST_DECODERS.get((root, xml_ver.split('.')[0] if xml_ver else None))
+            if fast_decoder is not None:
+                try:
+                    snapshot = fast_decoder(xmldata, root, device_id, xml_ver)
+                except (AttributeError, IndexError, TypeError, ValueError) as de:
+                    _LOGGER.debug("Falling back to the full decoder for type %s: %s", root, de)
+        unparseable = False
+        if snapshot is None:
+            root, snapshot, unparseable = self._decode_tree(xmldata)
+        return root, snapshot, time.perf_counter() - start, unparseable
 
-            data, _ = sock.recvfrom(1024)
-            self.on_data_received(data.decode('utf-8'))
+    def _decoded(self, root, snapshot, elapsed, unparseable):
+        """Store a decoded snapshot, if newer than the one of its class.
+        Returns whether it was, and the entities must be notified."""
+        if unparseable:
+            self.counters[COUNTER_UNPARSEABLE] += 1
+        if snapshot is None:
+            return False
+        self.histograms[HISTOGRAM_DECODE].record(elapsed)
+        self._seen(root, snapshot)
+        # legacy packets carry no timestamp, hence they are always accepted,
+        # and so are the packets replacing restored data
+        last = self.data.get(root)
+        if last is not None and snapshot.timestamp and snapshot.timestamp <= last.timestamp and \
+           root not in self.restored:
+            self.counters[COUNTER_STALE] += 1
+            return False
+        self.data[root] = snapshot
+        self.counters[COUNTER_ACCEPTED] += 1
+        if self.restored:
+            self.restored.discard(root)
+        if self._store is not None and not self._save_pending:
+            self._save_pending = True
+            self._store.async_delay_save(self._snapshots_to_save, SNAPSHOTS_SAVE_DELAY)
+        if self.history_config is not None:
+            self._record_history(root, snapshot)
+        if self.energy is not None:
+            self.energy.integrate(root, snapshot)
+        if self.exporter is not None:
+            self.exporter.invalidate()
+        return True
 
-    def on_data_received(self, xmldata):
-        """Callback when new data is received: store it in the dict"""
+    def _decode_tree(self, xmldata):
+        """Parse the packet into a full element tree and decode it.
+        Returns the OWL class, the snapshot, which is None on errors, and
+        whether the packet is invalid."""
         try:
             xml = ET.fromstring(xmldata)
-            self.data[xml.tag] = xml
-            _LOGGER.debug("Datagram received for type %s", xml.tag)
-
         except ET.ParseError as pe:
             _LOGGER.error("Unable to parse received data: %s", pe)
+            return None, None, True
+        _LOGGER.debug("Datagram received for type %s", xml.tag)
+        decoder = OWL_DECODERS.get(xml.tag)
+        if decoder is None:
+            return xml.tag, None, False
+        try:
+            return xml.tag, decoder(xml), False
+        except (AttributeError, IndexError, KeyError, TypeError, ValueError) as de:
+            _LOGGER.error("Unable to decode received data for type %s: %s", xml.tag, de)
+            return xml.tag, None, True
+
+    def start_workers(self, loop):
+        """Start the parsing workers, if configured: the snapshots they
+        decode are handed back to the given event loop"""
+        if not self._workers or self._threads:
+            return
+        self._loop = loop
+        # each start has its own event, so that workers still finishing
+        # a packet after a stop never pick up the ones of a restart
+        self._stopping = threading.Event()
+        self._threads = [threading.Thread(target=self._run_worker, args=(self._stopping,),
+                                          name=f'{DOMAIN}_worker_{index}', daemon=True)
+                         for index in range(self._workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def stop_workers(self):
+        """Signal the parsing workers to stop, discarding the queued
+        packets. They are not waited for, as this runs in the event loop."""
+        if not self._threads:
+            return
+        self._threads = []
+        with self._queue_cond:
+            self._stopping.set()
+            self._queue.clear()
+            self._queue_cond.notify_all()
+
+    @property
+    def queue_pending(self):
+        """Number of packets queued for the workers and not stored yet"""
+        return self._queued - self.counters[COUNTER_QUEUE_DROPPED] - self._applied
+
+    def _enqueue(self, item):
+        """Queue a packet for the workers, dropping the oldest one if full"""
+        with self._queue_cond:
+            if len(self._queue) == WORKER_QUEUE_SIZE:
+                self.counters[COUNTER_QUEUE_DROPPED] += 1
+            self._queue.append(item)
+            self._queued += 1
+            if len(self._queue) > self.queue_high_water:
+                self.queue_high_water = len(self._queue)
+            self._queue_cond.notify()
+
+    def _run_worker(self, stopping):
+        """Worker thread: decode the queued packets, and have the event
+        loop store them, with a single call for all the ones ready"""
+        while True:
+            with self._queue_cond:
+                while not self._queue and not stopping.is_set():
+                    self._queue_cond.wait()
+                if stopping.is_set():
+                    return
+                item = self._queue.popleft()
+            xmldata, root, device_id, xml_ver, received_at = item
+            decoded = self._decode(xmldata, root, device_id, xml_ver)
+            with self._ready_lock:
+                if stopping.is_set():
+                    return
+                self._ready.append((decoded, received_at))
+                schedule = not self._apply_scheduled
+                self._apply_scheduled = True
+            if schedule:
+                try:
+                    self._loop.call_soon_threadsafe(self._async_apply_ready)
+                except RuntimeError:
+                    # the event loop is closed
+                    return
+
+    @callback
+    def _async_apply_ready(self):
+        """Store the snapshots decoded by the workers, and notify the
+        entities once per class for the whole batch"""
+        with self._ready_lock:
+            ready, self._ready = self._ready, []
+            self._apply_scheduled = False
+        notify = {}
+        for (root, snapshot, elapsed, unparseable), received_at in ready:
+            self._applied += 1
+            if self._decoded(root, snapshot, elapsed, unparseable):
+                notify[root] = received_at
+        for root, received_at in notify.items():
+            self.received_at = received_at
+            self._notify_packet(root)
+
+    def _record_history(self, owlclass, snapshot):
+        """Append the relevant readings of the snapshot to their series"""
+        now = time.monotonic()
+        for sensor_type in HISTORY_SENSORS.get(owlclass, ()):
+            for key, value in _history_keys(owlclass, snapshot, sensor_type):
+                if value is None:
+                    continue
+                series = self.history.get(key)
+                if series is None:
+                    series = self.history[key] = OwlSeries(
+                        self.history_config[CONF_HISTORY_SIZE],
+                        self.history_config[CONF_HISTORY_WINDOWS])
+                series.push(now, value)
+
+    async def async_load_snapshots(self, hass, key):
+        """Load the snapshots saved under the given storage key by a
+        previous run, flagging them as restored, and save the new ones
+        from now on. Their staleness is counted from now."""
+        self._store = Store(hass, SNAPSHOTS_STORAGE_VERSION, key)
+        saved = await self._store.async_load() or {}
+        now = time.monotonic()
+        for device_id, classes in saved.items():
+            if self.device_id and device_id != self.device_id:
+                continue
+            for owlclass, entry in classes.items():
+                if self.monitored is not None and owlclass not in self.monitored:
+                    continue
+                last = self.data.get(owlclass)
+                if last is not None and entry['snapshot'].get('timestamp', 0) <= last.timestamp:
+                    continue
+                try:
+                    snapshot = _restore_snapshot(owlclass, entry['snapshot'])
+                except (KeyError, TypeError) as err:
+                    _LOGGER.debug("Unable to restore the %s data: %s", owlclass, err)
+                    continue
+                if snapshot is None:
+                    continue
+                self.data[owlclass] = snapshot
+                self.restored.add(owlclass)
+                self.last_seen[owlclass] = now
+                if owlclass in ZONED_CLASSES:
+                    for zone in snapshot.zones:
+                        self.zone_last_seen[(owlclass, zone.zone_id)] = now
+        if self.restored:
+            _LOGGER.debug("Restored the %s data", ', '.join(sorted(self.restored)))
+
+    def _snapshots_to_save(self):
+        """Return the latest snapshots by station and class, with the time
+        they were received, to be saved by the store"""
+        self._save_pending = False
+        now, monotonic = time.time(), time.monotonic()
+        saved = {}
+        for owlclass, snapshot in self.data.items():
+            saved.setdefault(snapshot.device_id or '', {})[owlclass] = {
+                'received': round(now - (monotonic - self.last_seen.get(owlclass, monotonic))),
+                'snapshot': asdict(snapshot),
+            }
+        return saved
+
+    def subscribe(self, owlclass, subscriber):
+        """Register a callback to be invoked when data for the given
+        class is received. Returns a function to unsubscribe it."""
+        self._subscribers.setdefault(owlclass, set()).add(subscriber)
+
+        def unsubscribe():
+            subscribers = self._subscribers.get(owlclass)
+            if subscribers is not None:
+                subscribers.discard(subscriber)
+                if not subscribers:
+                    del self._subscribers[owlclass]
+
+        return unsubscribe
+
+    def _notify(self, owlclass):
+        """Notify the subscribers of the given class"""
+        for subscriber in list(self._subscribers.get(owlclass, ())):
+            subscriber()
 
     def get(self, owlclass):
         """Facade for the internal dictionary's get method"""
         return self.data.get(owlclass)
 
+    @property
+    def listener_counters(self):
+        """The counters of the shared listener"""
+        return self._listener.counters if self._listener is not None else Counter()
+
+    def _seen(self, owlclass, snapshot):
+        """A packet of the class was received, with the zones of the
+        snapshot: they are all fresh. Zones are tracked by id, as their
+        position changes when some of them stop reporting."""
+        now = self.last_seen[owlclass] = time.monotonic()
+        if owlclass in ZONED_CLASSES:
+            for zone in snapshot.zones:
+                self.zone_last_seen[(owlclass, zone.zone_id)] = now
+        if self.stale:
+            self._clear_stale(owlclass, snapshot)
+
+    def _notify_packet(self, owlclass):
+        """Notify the subscribers of the given class of a new packet,
+        telling them it was received while they are notified"""
+        self.packet_class = owlclass
+        try:
+            self._notify(owlclass)
+        finally:
+            self.packet_class = None
+
+    def _clear_stale(self, owlclass, snapshot):
+        """A packet was received: the class and its zones are fresh again"""
+        if owlclass in self.stale:
+            self.stale.discard(owlclass)
+            _LOGGER.info("Receiving %s data again", owlclass)
+        if owlclass in ZONED_CLASSES:
+            for zone in snapshot.zones:
+                self.stale.discard((owlclass, zone.zone_id))
+
+    @callback
+    def async_check_stale(self, now=None):
+        """Watchdog run periodically in the event loop: mark as stale the
+        classes and zones not received within their threshold, and notify
+        the affected entities. Its cost depends on the number of classes
+        and zones, not on the number of entities."""
+        monotonic = time.monotonic()
+        changed = set()
+        for last_seen in (self.last_seen, self.zone_last_seen):
+            for key, seen in last_seen.items():
+                owlclass = key[0] if isinstance(key, tuple) else key
+                if key not in self.stale and monotonic - seen > self.stale_after[owlclass]:
+                    if key == owlclass or owlclass not in self.stale:
+                        _LOGGER.warning("No %s data received for %s seconds",
+                                        owlclass if key == owlclass else f"{owlclass} zone {key[1]}",
+                                        int(monotonic - seen))
+                    self.stale.add(key)
+                    changed.add(owlclass)
+        if changed and self.exporter is not None:
+            self.exporter.invalidate()
+        for owlclass in changed:
+            self._notify(owlclass)
+
+    def is_stale(self, owlclass, zone_id=None):
+        """Whether the data for the given class, or zone id, are stale"""
+        return owlclass in self.stale or (owlclass, zone_id) in self.stale
+
+    def last_packet_age(self, owlclass):
+        """Seconds since the last valid packet of the given class, if any"""
+        last_seen = self.last_seen.get(owlclass)
+        return time.monotonic() - last_seen if last_seen is not None else None
+
+    def diagnostics(self):
+        """Return the counters, timings and profile of this OwlData"""
+        counters = dict(self.counters)
+        if _BIND_FAILURES[self._binding]:
+            # failed attempts to set up this platform, before this OwlData
+            counters[COUNTER_BIND_FAILED] = _BIND_FAILURES[self._binding]
+        diag = {
+            'binding': list(self._binding) if self._binding else None,
+            'device_id': self.device_id,
+            'device_ids_seen': sorted(str(d) for d in self._device_ids),
+            'counters': counters,
+            'listener_counters': dict(self.listener_counters),
+            'received': dict(self.received),
+            'last_packet_age_s': {owlclass: round(self.last_packet_age(owlclass), 1)
+                                  for owlclass in self.last_seen},
+            'stale': sorted(str(key) for key in self.stale),
+            'histograms': {name: histogram.as_dict() for name, histogram in self.histograms.items()},
+        }
+        if self.recorder is not None:
+            diag['capture'] = dict(self.recorder.counters, path=self.recorder.path)
+        if self.exporter is not None:
+            diag['exporter'] = {'host': self.exporter.host, 'port': self.exporter.port}
+        if self._workers:
+            diag['workers'] = {
+                'threads': len(self._threads),
+                'queue_depth': len(self._queue),
+                'queue_high_water': self.queue_high_water,
+                'queue_size': WORKER_QUEUE_SIZE,
+                'dropped': self.counters[COUNTER_QUEUE_DROPPED],
+            }
+        if self._profiler is not None:
+            out = io.StringIO()
+            pstats.Stats(self._profiler, stream=out).sort_stats('cumulative').print_stats(PROFILE_TOP_FUNCTIONS)
+            diag['profile'] = out.getvalue().splitlines()
+        return diag
+
 
 class OwlIntuitionSensor(SensorEntity):
-    """Implementation of the OWL Intuition Power Meter sensors."""
+    """Implementation of the OWL Intuition Power Meter sensors.
+    The state is pushed by OwlData when a packet of the relevant class
+    is received, hence no polling is needed.
+    State writes can be throttled per class and sensor type: a new value
+    is then written only if it differs enough from the last one written,
+    and no sooner than min_interval after it, in which case its write is
+    deferred. With a heartbeat, the value is written at least that often
+    while data are received."""
+
+    _attr_should_poll = False
+    _sensor_types = SENSOR_TYPES
+    _restored = False
 
-    def __init__(self, owldata, sensor_name, sensor_type, phase=0, zone=1, zones_count=1):
+    def __init__(self, owldata, sensor_name, sensor_type, phase=0, zone=1, zones_count=1, throttle=None,
+                 zone_id=None):
         """Set all the config values if they exist and get initial state."""
         self._owldata = owldata
         self._sensor_type = sensor_type
         self._phase = phase
-        self._attr_name = f'{sensor_name} {SENSOR_TYPES[sensor_type][0]}'
+        self._attr_name = f'{sensor_name} {self._sensor_types[sensor_type][0]}'
         if phase > 0:
             self._attr_name += f' P{phase}'
         self._zone = zone
         self._name_zone_updated = (zones_count == 1)
+        # the id of the zone, once known the zone is looked up by id, as
+        # its position changes when other zones stop reporting
+        self._zone_id = zone_id
+        if zone_id is not None:
+            # the zone is already known, e.g. when discovered
+            self._attr_name += f" ({zone_id})"
+            self._name_zone_updated = True
         self._attr_attribution = POWERED_BY
-        self._attr_native_unit_of_measurement = SENSOR_TYPES[sensor_type][1]
-        self._attr_icon = SENSOR_TYPES[sensor_type][2]
-        self._owl_class = SENSOR_TYPES[sensor_type][3]
-        self._attr_device_class = SENSOR_TYPES[sensor_type][4]
-        self._attr_state_class = SENSOR_TYPES[sensor_type][5]
+        self._attr_native_unit_of_measurement = self._sensor_types[sensor_type][1]
+        self._attr_icon = self._sensor_types[sensor_type][2]
+        self._owl_class = self._sensor_types[sensor_type][3]
+        self._attr_device_class = self._sensor_types[sensor_type][4]
+        self._attr_state_class = self._sensor_types[sensor_type][5]
+        self._value_of = SENSOR_VALUES.get(sensor_type)
+        self._history_key = (sensor_type, phase, zone_id if self._owl_class in ZONED_CLASSES else 0)
+        # settings of the sensor type override the ones of the class
+        self._throttle = dict((throttle or {}).get(self._owl_class, {}),
+                              **(throttle or {}).get(sensor_type, {})) or None
+        self._attributes = None
+        self._written_value = None
+        self._written_attrs = None
+        self._written_at = None
+        self._pending_write = None
+
+    async def async_added_to_hass(self):
+        """Subscribe to the updates of our OWL class"""
+        self.async_on_remove(
+            self._owldata.subscribe(self._owl_class, self._async_data_received))
+        self.async_on_remove(self._async_cancel_pending_write)
+        self.update()
+
+    @callback
+    def _async_data_received(self):
+        """Refresh the state upon reception of new data, or when the data
+        become stale, and write it only if it actually changed"""
+        value, name, available, restored = \
+            self._attr_native_value, self._attr_name, self._attr_available, self._restored
+        histograms = self._owldata.histograms
+        start = time.perf_counter()
+        self.update()
+        end = time.perf_counter()
+        histograms[HISTOGRAM_UPDATE].record(end - start)
+        if self._attr_name != name or self._attr_available != available or \
+           self._restored != restored:
+            write = True
+        elif self._throttle is None:
+            write = self._attr_native_value != value or self._aggregates_changed()
+        else:
+            write = self._throttled_write_due()
+        if write:
+            self._async_write()
+            # only the writes caused by a packet of our class, not the ones
+            # of the watchdog, e.g. when the restored data become stale
+            if self._owldata.packet_class == self._owl_class:
+                histograms[HISTOGRAM_WRITE].record(time.perf_counter() - self._owldata.received_at)
+
+    def _aggregates_changed(self):
+        """Whether the aggregates over the history windows differ from the
+        ones written, e.g. as a spike leaves a window with a flat value"""
+        if self._owldata.history.get(self._history_key) is None:
+            return False
+        return self._attributes != self._written_attrs
+
+    def _changed_enough(self):
+        """Whether the value differs enough from the last one written"""
+        value, written = self._attr_native_value, self._written_value
+        if value == written:
+            return False
+        if not isinstance(value, (int, float)) or not isinstance(written, (int, float)):
+            return True
+        delta = self._throttle.get(CONF_THROTTLE_DELTA)
+        delta_pct = self._throttle.get(CONF_THROTTLE_DELTA_PCT)
+        if delta is None and delta_pct is None:
+            return True
+        change = abs(value - written)
+        return (delta is not None and change >= delta) or \
+               (delta_pct is not None and (not written or change * 100 >= delta_pct * abs(written)))
+
+    def _throttled_write_due(self):
+        """Whether the value must be written now under throttling. If it
+        changed enough but was written too recently, its write is deferred
+        to the end of the min interval."""
+        elapsed = time.monotonic() - self._written_at if self._written_at is not None else None
+        heartbeat = self._throttle.get(CONF_THROTTLE_HEARTBEAT)
+        if heartbeat is not None and elapsed is not None and elapsed >= heartbeat:
+            return True
+        if not self._changed_enough():
+            return False
+        min_interval = self._throttle.get(CONF_THROTTLE_MIN_INTERVAL, 0)
+        if elapsed is None or elapsed >= min_interval:
+            return True
+        self._owldata.counters[COUNTER_THROTTLED] += 1
+        if self._pending_write is None:
+            self._pending_write = async_call_later(self.hass, min_interval - elapsed,
+                                                   self._async_write_pending)
+        return False
+
+    @callback
+    def _async_write_pending(self, _now):
+        """End of the min interval: write the deferred value"""
+        self._pending_write = None
+        if self._changed_enough():
+            self._async_write()
+
+    @callback
+    def _async_cancel_pending_write(self):
+        """Cancel the deferred write, if any"""
+        if self._pending_write is not None:
+            self._pending_write()
+            self._pending_write = None
+
+    @callback
+    def _async_write(self):
+        """Write the state, and remember what was written and when"""
+        self._async_cancel_pending_write()
+        self._written_value = self._attr_native_value
+        if self._owldata.history.get(self._history_key) is not None:
+            self._written_attrs = self._attributes
+        self._written_at = time.monotonic()
+        self.async_write_ha_state()
+
+    @property
+    def extra_state_attributes(self):
+        """Expose whether the state was restored from a previous run, and
+        the aggregates over the configured history windows, as computed by
+        the last update: they are read several times per packet"""
+        return self._attributes
+
+    def _state_attributes(self):
+        """Compute the attributes: the percentiles sort their windows"""
+        attrs = {'restored': True} if self._restored else {}
+        series = self._owldata.history.get(self._history_key)
+        if series is None:
+            return attrs or None
+        config = self._owldata.history_config
+        now = time.monotonic()
+        for duration in config[CONF_HISTORY_WINDOWS]:
+            stats = series.stats(duration, now)
+            if stats is None:
+                continue
+            attrs[f'min_{duration}s'], attrs[f'max_{duration}s'], mean, _ = stats
+            attrs[f'mean_{duration}s'] = round(mean, 2)
+            percents = config[CONF_HISTORY_PERCENTILES]
+            if percents:
+                for percent, value in zip(percents, series.percentiles(duration, percents, now)):
+                    attrs[f'p{percent:g}_{duration}s'] = value
+        return attrs
 
     def update(self):
-        """Retrieve the latest value for this sensor."""
-        self._owldata.update()
-        xml = self._owldata.get(self._owl_class)
-        if xml is None:
+        """Retrieve the latest value and attributes of this sensor"""
+        self._update_value()
+        self._attributes = self._state_attributes()
+
+    def _update_value(self):
+        """Retrieve the latest value for this sensor from the cached snapshot."""
+        snapshot = self._owldata.get(self._owl_class)
+        if snapshot is None:
             return
-        xml_ver = xml.attrib.get('ver')
-        if (xml.tag == OWLCLASS_HEATING or xml.tag == OWLCLASS_HOTWATER or xml.tag == OWLCLASS_RELAYS):
-            # Extract the relevant zone for the multizone sensors
-            try:
-                zone = xml.find('zones')[self._zone]
+        self._restored = self._owl_class in self._owldata.restored
+        if self._owl_class in ZONED_CLASSES:
+            # Extract the relevant zone for the multizone sensors: when not
+            # reported, the value is kept until the zone goes stale
+            if self._zone_id is not None:
+                snapshot = snapshot.zone_by_id(self._zone_id)
+                if snapshot is None:
+                    self._attr_available = not self._owldata.is_stale(self._owl_class, self._zone_id)
+                    return
+            else:
+                snapshot = snapshot.zone(self._zone)
+                if snapshot is None:
+                    self._attr_available = not self._owldata.is_stale(self._owl_class)
+                    return
                 if not self._name_zone_updated:
-                    self._name += f" ({zone.attrib['id']})"
+                    self._attr_name += f" ({snapshot.zone_id})"
                     self._name_zone_updated = True
-                xml = zone
-            except IndexError:
-                # fallback to the first one
-                xml = xml.find('zones/zone')
+                    self._zone_id = snapshot.zone_id
+            self._attr_available = not self._owldata.is_stale(self._owl_class, snapshot.zone_id)
+            self._history_key = (self._sensor_type, self._phase, snapshot.zone_id)
+        else:
+            self._attr_available = not self._owldata.is_stale(self._owl_class)
 
         # Update the state of the current sensor: we use _attr_native_value and not _state because of #36
-        # Radio sensors
-        if self._attr_device_class == SensorDeviceClass.SIGNAL_STRENGTH:
-            self._attr_native_value = int(xml.find('signal').attrib['rssi'])
-        elif self._sensor_type == SENSOR_ELECTRICITY_BATTERY_LVL:
-            # Battery level in % for OWLCLASS_ELECTRICITY, mV for others
-            self._attr_native_value = int(xml.find("battery").attrib['level'][:-1])
-        elif self._sensor_type in [SENSOR_HOTWATER_BATTERY_LVL, SENSOR_HEATING_BATTERY_LVL]:
-            self._attr_native_value = round(float(xml.find("battery").attrib['level'])/1000, 2)
-        elif self._sensor_type == SENSOR_ELECTRICITY_BATTERY:
-            batt_lvl = int(xml.find("battery").attrib['level'][:-1])
-            if batt_lvl > 90:
-                self._attr_native_value = 'High'
-            elif batt_lvl > 30:
-                self._attr_native_value = 'Medium'
-            elif batt_lvl > 10:
-                self._attr_native_value = 'Low'
-            else:
-                self._attr_native_value = 'Very Low'
-        elif self._sensor_type in [SENSOR_HOTWATER_BATTERY, SENSOR_HEATING_BATTERY]:
-            # 2670mV = 66%
-            # 2780mV = 76%
-            batt_lvl = int(xml.find("battery").attrib['level'])
-            if batt_lvl > 2900:
-                self._attr_native_value = 'High'
-            elif batt_lvl > 2750:
-                self._attr_native_value = 'Medium'
-            elif batt_lvl > 2600:
-                self._attr_native_value = 'Low'
+        try:
+            self._attr_native_value = self._value_of(snapshot, self._phase)
+        except IndexError:
+            _LOGGER.warning("Phase %s not reported for sensor %s", self._phase, self._attr_name)
+
+
+class OwlEnergySensor(OwlIntuitionSensor, RestoreSensor):
+    """Lifetime energy sensor, integrated by OwlData from the power
+    readings. Its last state is saved by HA and restored at startup,
+    so that the total keeps increasing across restarts."""
+
+    _sensor_types = ENERGY_SENSOR_TYPES
+
+    def __init__(self, owldata, sensor_name, sensor_type, phase=0, throttle=None):
+        """Set all the config values"""
+        super().__init__(owldata, sensor_name, sensor_type, phase=phase, zone=0, throttle=throttle)
+        self._energy_key = (ENERGY_SOURCES[sensor_type], phase, 0)
+
+    async def async_added_to_hass(self):
+        """Resume from the last saved total, and subscribe to the updates"""
+        last = await self.async_get_last_sensor_data()
+        if last is not None and last.native_value is not None:
+            try:
+                self._owldata.energy.restore(self._energy_key, float(last.native_value) * 1000)
+            except ValueError:
+                _LOGGER.warning("Unable to restore the total of sensor %s", self._attr_name)
+        await super().async_added_to_hass()
+
+    def _update_value(self):
+        """Retrieve the latest total for this sensor"""
+        total = self._owldata.energy.totals.get(self._energy_key)
+        if total is None:
+            return
+        self._attr_available = not self._owldata.is_stale(self._owl_class)
+        self._attr_native_value = round(total / 1000, 3)
+
+
+class OwlDiscovery:
+    """Creates the sensors of an OwlData as their data first show up in
+    the packets: the sensors of a class when it is first received, with
+    a value, the sensors of each zone reported, named after its id, and
+    the per-phase sensors of the electricity channels with data."""
+
+    def __init__(self, owldata, sensor_name, async_add_entities, triphase=False,
+                 lifetime_energy=False, throttle=None):
+        """Set all the config values"""
+        self._owldata = owldata
+        self._sensor_name = sensor_name
+        self._async_add_entities = async_add_entities
+        self._triphase = triphase
+        self._lifetime_energy = lifetime_energy
+        self._throttle = throttle
+        self._created = set()
+
+    @callback
+    def async_start(self):
+        """Discover the sensors of the data already known, if restored,
+        and of the data to come"""
+        for owlclass in self._owldata.monitored or OWL_CLASSES:
+            self._owldata.subscribe(owlclass, functools.partial(self._async_discover, owlclass))
+            self._async_discover(owlclass)
+
+    def _discovered(self, owlclass, snapshot):
+        """Yield the (sensor_type, phase, zone id) and zone id of the sensors
+        with data in the snapshot"""
+        sensor_types = [sensor_type for sensor_type, props in SENSOR_TYPES.items() if props[3] == owlclass]
+        if owlclass in ZONED_CLASSES:
+            for zone_snapshot in snapshot.zones:
+                for sensor_type in sensor_types:
+                    if SENSOR_VALUES[sensor_type](zone_snapshot, 0) is not None:
+                        yield (sensor_type, 0, zone_snapshot.zone_id), zone_snapshot.zone_id
+            return
+        for sensor_type in sensor_types:
+            if SENSOR_VALUES[sensor_type](snapshot, 0) is not None:
+                yield (sensor_type, 0, 0), None
+        if self._lifetime_energy:
+            for sensor_type, props in ENERGY_SENSOR_TYPES.items():
+                if props[3] == owlclass:
+                    yield (sensor_type, 0, 0), None
+        if owlclass == OWLCLASS_ELECTRICITY:
+            # unused clamps report neither power nor energy, and a single
+            # clamp in use would only duplicate the totals
+            phases = [phase for phase, channel in enumerate(snapshot.channels, 1)
+                      if channel.power or channel.energy_today]
+            if self._triphase or len(phases) > 1:
+                for phase in phases:
+                    yield (SENSOR_ELECTRICITY_POWER, phase, 0), None
+                    yield (SENSOR_ELECTRICITY_ENERGY_TODAY, phase, 0), None
+                    if self._lifetime_energy:
+                        yield (SENSOR_ELECTRICITY_ENERGY_TOTAL, phase, 0), None
+
+    @callback
+    def _async_discover(self, owlclass):
+        """Create the sensors for the data not seen before"""
+        snapshot = self._owldata.get(owlclass)
+        if snapshot is None:
+            return
+        entities = []
+        for key, zone_id in self._discovered(owlclass, snapshot):
+            if key in self._created:
+                continue
+            self._created.add(key)
+            sensor_type, phase, _ = key
+            if sensor_type in ENERGY_SENSOR_TYPES:
+                entities.append(OwlEnergySensor(self._owldata, self._sensor_name, sensor_type,
+                                                phase=phase, throttle=self._throttle))
             else:
-                self._attr_native_value = 'Very Low'
-
-        # Electricity sensors
-        elif self._sensor_type == SENSOR_ELECTRICITY_POWER:
-            if self._phase == 0:
-                # xml_ver undefined for older version
-                if xml_ver is None:
-                    self._attr_native_value = int(float(xml.find('chan/curr').text))
-                else:
-                    self._attr_native_value = int(float(xml.find('property/current/watts').text))
+                entities.append(OwlIntuitionSensor(self._owldata, self._sensor_name, sensor_type,
+                                                   phase=phase, throttle=self._throttle,
+                                                   zone_id=zone_id))
+        if entities:
+            _LOGGER.info("Discovered %s new %s sensors", len(entities), owlclass)
+            self._async_add_entities(entities)
+
+
+class OwlDiagnosticSensor(SensorEntity):
+    """Diagnostic sensor about the packets received by an OwlData and
+    their processing. It is polled, as it only reads counters."""
+
+    _attr_entity_category = EntityCategory.DIAGNOSTIC
+
+    def __init__(self, owldata, sensor_name, diagnostic_type, owlclass=None):
+        """Set all the config values"""
+        self._owldata = owldata
+        self._owl_class = owlclass
+        self._attr_name = f'{sensor_name} {DIAGNOSTIC_TYPES[diagnostic_type][0]}'
+        if owlclass is not None:
+            self._attr_name += f' ({owlclass})'
+        self._attr_native_unit_of_measurement = DIAGNOSTIC_TYPES[diagnostic_type][1]
+        self._attr_icon = DIAGNOSTIC_TYPES[diagnostic_type][2]
+        self._attr_state_class = DIAGNOSTIC_TYPES[diagnostic_type][3]
+        self._value_of = DIAGNOSTIC_TYPES[diagnostic_type][4]
+        self.update()
+
+    def update(self):
+        """Read the latest value from the OwlData"""
+        self._attr_native_value = self._value_of(self._owldata, self._owl_class)
+
+
+#
+# Metrics: the snapshots exported in the Prometheus text format
+#
+
+def _electricity_metrics(s):
+    """Yield the (metric, labels, value) of an electricity snapshot"""
+    yield 'owl_electricity_power_watts', 'channel="total"', s.power
+    yield 'owl_electricity_energy_today_kwh', 'channel="total"', s.energy_today
+    for index, channel in enumerate(s.channels, 1):
+        yield 'owl_electricity_power_watts', f'channel="{index}"', channel.power
+        yield 'owl_electricity_energy_today_kwh', f'channel="{index}"', channel.energy_today
+    yield 'owl_electricity_cost_today', '', s.cost_today
+    yield 'owl_electricity_tariff_price', '', s.tariff_price
+    yield 'owl_rssi_dbm', 'class="electricity"', s.rssi
+    yield 'owl_electricity_battery_percent', '', s.battery_level
+
+
+def _solar_metrics(s):
+    """Yield the (metric, labels, value) of a solar snapshot"""
+    yield 'owl_solar_generating_watts', '', s.generating
+    yield 'owl_solar_exporting_watts', '', s.exporting
+    yield 'owl_solar_generated_today_kwh', '', s.generated_today
+    yield 'owl_solar_exported_today_kwh', '', s.exported_today
+
+
+def _zones_metrics(s, owlclass):
+    """Yield the (metric, labels, value) of a multi-zone snapshot"""
+    for zone in s.zones:
+        labels = f'class="{owlclass}",zone="{zone.zone_id}"'
+        yield 'owl_zone_temperature_celsius', labels, zone.current
+        yield 'owl_zone_required_celsius', labels, zone.required
+        yield 'owl_zone_ambient_celsius', labels, zone.ambient
+        yield 'owl_zone_battery_volts', labels, zone.battery_level
+        yield 'owl_rssi_dbm', labels, zone.rssi
+
+
+EXPORTED_METRICS = {
+    OWLCLASS_ELECTRICITY: lambda s, c: _electricity_metrics(s),
+    OWLCLASS_SOLAR: lambda s, c: _solar_metrics(s),
+    OWLCLASS_HOTWATER: _zones_metrics,
+    OWLCLASS_HEATING: _zones_metrics,
+    OWLCLASS_RELAYS: _zones_metrics,
+}
+
+METRICS_HELP = {
+    'owl_electricity_power_watts': 'Electricity power, in total and per channel',
+    'owl_electricity_energy_today_kwh': 'Electricity used today, in total and per channel',
+    'owl_electricity_cost_today': 'Cost of the electricity used today',
+    'owl_electricity_tariff_price': 'Current tariff price',
+    'owl_electricity_battery_percent': 'Battery level of the electricity transmitter',
+    'owl_solar_generating_watts': 'Solar power being generated',
+    'owl_solar_exporting_watts': 'Solar power being exported',
+    'owl_solar_generated_today_kwh': 'Solar energy generated today',
+    'owl_solar_exported_today_kwh': 'Solar energy exported today',
+    'owl_zone_temperature_celsius': 'Current temperature of the zone',
+    'owl_zone_required_celsius': 'Required temperature of the zone',
+    'owl_zone_ambient_celsius': 'Ambient temperature of the zone',
+    'owl_zone_battery_volts': 'Battery voltage of the zone',
+    'owl_rssi_dbm': 'Radio signal strength',
+    'owl_lifetime_energy_kwh_total': 'Lifetime energy integrated from the power readings',
+    'owl_last_update_timestamp_seconds': 'Timestamp of the last packet, as reported by the station',
+}
+
+
+class OwlExporter:
+    """Serves the latest readings of an OwlData in the Prometheus text
+    format over HTTP. The page is rendered straight from the snapshots at
+    the first scrape after new data, and served as is until the next ones,
+    so that frequent scrapes cost no more than a write to the socket.
+    The data of stale classes are not exported."""
+
+    def __init__(self, owldata, host, port):
+        """Prepare an empty page"""
+        self._owldata = owldata
+        self.host = host
+        self.port = port
+        self._server = None
+        self._page = None
+
+    async def async_start(self):
+        """Start serving the metrics"""
+        try:
+            self._server = await asyncio.start_server(self._async_handle, self.host, self.port)
+        except OSError as err:
+            _LOGGER.error("Unable to serve the metrics on %s port %s: %s", self.host, self.port, err)
+            return False
+        return True
+
+    def async_stop(self):
+        """Stop serving the metrics"""
+        if self._server is not None:
+            self._server.close()
+        self._server = None
+
+    def invalidate(self):
+        """New data were received: render the page again at the next scrape"""
+        self._page = None
+
+    @property
+    def page(self):
+        """The rendered page, as bytes"""
+        if self._page is None:
+            self._page = self._render()
+        return self._page
+
+    def _render(self):
+        """Render the metrics of the snapshots not stale"""
+        owldata = self._owldata
+        samples = {name: [] for name in METRICS_HELP}
+        for owlclass, snapshot in owldata.data.items():
+            exported = EXPORTED_METRICS.get(owlclass)
+            if exported is None or owlclass in owldata.stale:
+                continue
+            device = f'device_id="{snapshot.device_id or ""}"'
+            for name, labels, value in exported(snapshot, owlclass):
+                if value is not None:
+                    samples[name].append(f'{name}{{{device},{labels}}} {value}' if labels else
+                                         f'{name}{{{device}}} {value}')
+            samples['owl_last_update_timestamp_seconds'].append(
+                f'owl_last_update_timestamp_seconds{{{device},class="{owlclass}"}} {snapshot.timestamp}')
+        if owldata.energy is not None:
+            for (sensor_type, phase, _), total in owldata.energy.totals.items():
+                snapshot = owldata.data.get(SENSOR_TYPES[sensor_type][3])
+                device = snapshot.device_id if snapshot is not None else None
+                samples['owl_lifetime_energy_kwh_total'].append(
+                    f'owl_lifetime_energy_kwh_total{{device_id="{device or ""}",reading="{ENERGY_READINGS[sensor_type]}",'
+                    f'channel="{phase or "total"}"}} {total / 1000:.3f}')
+        lines = []
+        for name, metric_samples in samples.items():
+            if metric_samples:
+                lines.append(f'# HELP {name} {METRICS_HELP[name]}')
+                lines.append(f'# TYPE {name} {"counter" if name.endswith("_total") else "gauge"}')
+                lines.extend(metric_samples)
+        lines.append('')
+        return '\n'.join(lines).encode('utf-8')
+
+    async def _async_handle(self, reader, writer):
+        """Answer an HTTP request: the page for GET /metrics, or an error"""
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), EXPORTER_TIMEOUT)
+            method, path, _ = request.split(b' ', 2)
+            if method == b'GET' and path.split(b'?')[0] in (b'/metrics', b'/'):
+                status, body = b'200 OK', self.page
             else:
-                if xml_ver is None:
-                    self._attr_native_value = int(float(xml.findall('chan')[self._phase-1].
-                                            find('curr').text))
-                else:
-                    self._attr_native_value = int(float(xml.find('channels').
-                                            findall('chan')[self._phase-1].
-                                            find('curr').text))
-        elif self._sensor_type == SENSOR_ELECTRICITY_ENERGY_TODAY:
-            if self._phase == 0:
-                # xml_ver undefined for older version
-                if xml_ver is None:
-                    self._attr_native_value = round(float(xml.find('chan/day').text)/1000,2)
-                else:
-                    self._attr_native_value = round(float(xml.find('property/day/wh').text)/1000, 2)
+                status, body = b'404 Not Found', b''
+            writer.write(b'HTTP/1.0 %s\r\nContent-Type: %s\r\nContent-Length: %d\r\n\r\n'
+                         % (status, EXPORTER_CONTENT_TYPE, len(body)) + body)
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError,
+                ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+
+class OwlListener:
+    """The UDP listener for a given binding, shared by all the OwlData
+    using it: each packet is routed to the OwlData pinned to the station
+    that sent it, or to the ones not pinned to any station.
+    Datagrams are read by the event loop into a single reusable buffer
+    sized for the largest UDP payload, and truncation is detected."""
+
+    def __init__(self, binding):
+        """Prepare the routing tables"""
+        self._binding = binding
+        self._pinned = {}
+        self._unpinned = []
+        self._buffer = bytearray(MAX_DATAGRAM_SIZE)
+        self._view = memoryview(self._buffer)
+        self.counters = Counter()
+        self._sock = None
+        self._loop = None
+        self._warned_no_id = False
+
+    def _create_socket(self):
+        """Create and bind the UDP socket, joining the multicast group
+        when no unicast port is configured. Returns None on failure."""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        try:
+            if self._binding[1]:
+                _LOGGER.debug("Binding to: %s on port: %s", self._binding[0], self._binding[1])
+                sock.bind((self._binding[0], self._binding[1]))
             else:
-                if xml_ver is None:
-                    self._attr_native_value = round(float(xml.findall('chan')[self._phase-1].
-                                              find('day').text)/1000, 2)
-                else:
-                    self._attr_native_value = round(float(xml.find('channels').
-                                              findall('chan')[self._phase-1].
-                                              find('day').text)/1000, 2)
-        elif self._sensor_type == SENSOR_ELECTRICITY_COST_TODAY:
-            # xml_ver undefined for older version
-            if xml_ver is None:
-                self._attr_native_value = 0
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                _LOGGER.debug("Multicast Binding to %s on port %s", self._binding[2], self._binding[3])
+                sock.bind((self._binding[2], self._binding[3]))
+                sock.setsockopt(socket.SOL_IP, socket.IP_MULTICAST_IF, socket.inet_aton(self._binding[0]))
+                sock.setsockopt(socket.SOL_IP, socket.IP_ADD_MEMBERSHIP, socket.inet_aton(self._binding[2]) + socket.inet_aton(self._binding[0]))
+        except socket.error as se:
+            if self._binding[1]:
+                _LOGGER.error("Unable to bind to %s on %s error: %s", self._binding[0], self._binding[1], se)
             else:
-                # the measure comes in cent. of the configured currency
-                self._attr_native_value = round(float(xml.find('property/day/cost').text)/100, 3)
-
-        # Solar sensors
-        elif self._sensor_type == SENSOR_SOLAR_GPOWER:
-            self._attr_native_value = int(float(xml.find('current/generating').text))
-        elif self._sensor_type == SENSOR_SOLAR_EPOWER:
-            self._attr_native_value = int(float(xml.find('current/exporting').text))
-        elif self._sensor_type == SENSOR_SOLAR_GENERGY_TODAY:
-            self._attr_native_value = round(float(xml.find('day/generated').text)/1000, 2)
-        elif self._sensor_type == SENSOR_SOLAR_EENERGY_TODAY:
-            self._attr_native_value = round(float(xml.find('day/exported').text)/1000, 2)
-	  		
-        # Hot water sensors
-        if self._sensor_type == SENSOR_HOTWATER_CURRENT:
-            self._attr_native_value = round(float(xml.find('temperature/current').text),1)
-        elif self._sensor_type == SENSOR_HOTWATER_REQUIRED:
-            self._attr_native_value = float(xml.find('temperature/required').text)
-        elif self._sensor_type == SENSOR_HOTWATER_AMBIENT:
-            self._attr_native_value = float(xml.find('temperature/ambient').text)
-        elif self._sensor_type == SENSOR_HOTWATER_STATE:
-            # Heating state reported in version 2 and up
-            if xml_ver is not None:
-                self._attr_native_value = HOTWATER_STATE[int(xml.find('temperature').attrib['state'])]
-
-        # Heating Sensors
-        elif self._sensor_type == SENSOR_HEATING_CURRENT:
-            self._attr_native_value = round(float(xml.find('temperature/current').text),1)
-        elif self._sensor_type == SENSOR_HEATING_REQUIRED:
-            self._attr_native_value = float(xml.find('temperature/required').text)
-        elif self._sensor_type == SENSOR_HEATING_STATE:
-            # Heating state reported in version 2 and up
-            if xml_ver is not None:
-                self._attr_native_value = HEATING_STATE[int(xml.find('temperature').attrib['state'])]
-
-
-class OwlStateUpdater(asyncio.DatagramProtocol):
-    """An helper class for the async UDP listener loop.
-    More info at:
-    https://docs.python.org/3/library/asyncio-protocol.html"""
-
-    def __init__(self, eloop):
-        """Boiler-plate initialisation"""
-        self.eloop = eloop
-        self.transport = None
-
-    def connection_made(self, transport):
-        """Boiler-plate connection made method"""
-        self.transport = transport
-
-    def datagram_received(self, packet, addr_unused):
-        """Get the last received datagram and notify the
-        OwlData singleton for storing it if relevant"""
-        xmldata = packet.decode('utf-8')
-        root = xmldata[1:xmldata.find(' ')]
-
-        _LOGGER.debug("Datagram received for type %s", root)
-        
-        if root in OWL_CLASSES:
-            # do not call here that method, but instead leave
-            # the event loop do it when convenient AND thread-safe!
-            self.eloop.call_soon_threadsafe(
-                owldata.on_data_received, xmldata)
+                _LOGGER.error("Unable to bind to %s on %s error: %s", self._binding[2], self._binding[3], se)
+            sock.close()
+            return None
+        sock.setblocking(False)
+        return sock
+
+    async def async_start(self, hass):
+        """Bind the socket and start reading from it in the event loop"""
+        sock = self._create_socket()
+        if sock is None:
+            return False
+        self._sock = sock
+        self._loop = hass.loop
+        self._loop.add_reader(sock, self._on_readable)
+        return True
+
+    def async_stop(self):
+        """Close the listener and release the socket"""
+        if self._sock is not None:
+            self._loop.remove_reader(self._sock)
+            self._sock.close()
+        self._sock = None
+
+    def _on_readable(self):
+        """Drain the pending datagrams into the preallocated buffer, and
+        hand them over as views of it, without any intermediate copy"""
+        for _ in range(MAX_DATAGRAMS_PER_READ):
+            try:
+                nbytes, _, flags, source = self._sock.recvmsg_into([self._buffer])
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as err:
+                _LOGGER.error("Received error %s", err)
+                return
+            if flags & socket.MSG_TRUNC:
+                self.counters[COUNTER_TRUNCATED] += 1
+                _LOGGER.warning("Discarding datagram larger than %s bytes", MAX_DATAGRAM_SIZE)
+                continue
+            self.on_data_received(self._view[:nbytes], source)
+
+    def attach(self, owldata):
+        """Route to the given OwlData the packets of its station"""
+        if owldata.device_id:
+            self._pinned.setdefault(owldata.device_id, []).append(owldata)
+        else:
+            self._unpinned.append(owldata)
+
+    def detach(self, owldata):
+        """Stop routing packets to the given OwlData, and return whether
+        any other OwlData is still attached"""
+        if owldata.device_id:
+            self._pinned[owldata.device_id].remove(owldata)
+            if not self._pinned[owldata.device_id]:
+                del self._pinned[owldata.device_id]
+        else:
+            self._unpinned.remove(owldata)
+        return bool(self._pinned or self._unpinned)
+
+    def on_data_received(self, packet, source=None):
+        """Route a packet to the OwlData of the station that sent it"""
+        if self._pinned:
+            _, device_id, _ = _root_of(packet)
+            if device_id is None and not self._warned_no_id:
+                self._warned_no_id = True
+                _LOGGER.warning("Received a packet with no station id: it cannot be routed "
+                                "to the platforms configured with a device_id")
+            targets = self._pinned.get(device_id.upper() if device_id else None, self._unpinned)
         else:
-            _LOGGER.warning("Unsupported type '%s' in data: %s", \
-                            root, packet)
-
-    def error_received(self, exc):
-        """Boiler-plate error received method"""
-        _LOGGER.error("Received error %s", exc)
-
-    def cleanup(self):
-        """Boiler-plate cleanup method"""
-        if self.transport:
-            self.transport.close()
-        self.transport = None
+            targets = self._unpinned
+        for owldata in targets:
+            owldata.on_data_received(packet, source)
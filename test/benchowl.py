@@ -0,0 +1,285 @@
+#!/usr/bin/python3
+#
+# Benchmark of the datagram-to-state pipeline of the OWL Intuition sensors:
+# synthetic OWL packets are fed to OwlData.on_data_received() and fanned out
+# to the subscribed OwlIntuitionSensor entities, reporting the parse time,
+# the per-entity update time, the allocations and the end-to-end throughput.
+# The fast decoders are first checked against the tree decoders.
+#
+# It runs fully offline: the homeassistant modules are replaced by a minimal
+# stub, so that only the integration's own code is measured. Usage:
+#
+#   python3 test/benchowl.py [--packets N] [--channels 3 6] [--zones 1 4 8]
+#                            [--decoders tree fast] [--delta-pct 5]
+
+import argparse
+from dataclasses import asdict
+import os
+import re
+import sys
+import time
+import tracemalloc
+import types
+
+
+class _Anything:
+    """Permissive placeholder for any homeassistant symbol not
+    relevant to the benchmark (constants, schemas, validators)"""
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __call__(self, *args, **kwargs):
+        return _Anything()
+
+    def __getattr__(self, name):
+        return _Anything()
+
+
+class _SensorEntity:
+    """Minimal stand-in for homeassistant's SensorEntity"""
+    _attr_name = None
+    _attr_native_value = None
+    _attr_available = True
+    hass = None
+    writes = 0
+
+    def async_on_remove(self, func):
+        pass
+
+    def async_write_ha_state(self):
+        _SensorEntity.writes += 1
+
+
+def _stub_module(name, **attrs):
+    """Register a stub module resolving any unknown symbol to _Anything"""
+    module = types.ModuleType(name)
+    module.__dict__.update(attrs)
+    module.__getattr__ = lambda attr: _Anything()
+    sys.modules[name] = module
+    return module
+
+
+def install_stubs():
+    """Replace the homeassistant (and if missing, voluptuous) imports"""
+    for name in ('homeassistant', 'homeassistant.components',
+                 'homeassistant.config_entries', 'homeassistant.const',
+                 'homeassistant.exceptions', 'homeassistant.helpers',
+                 'homeassistant.helpers.entity',
+                 'homeassistant.helpers.entity_platform',
+                 'homeassistant.helpers.event',
+                 'homeassistant.helpers.storage',
+                 'homeassistant.helpers.typing',
+                 'homeassistant.helpers.config_validation',
+                 'homeassistant.util'):
+        _stub_module(name)
+    _stub_module('homeassistant.components.sensor', SensorEntity=_SensorEntity,
+                 RestoreSensor=_SensorEntity)
+    _stub_module('homeassistant.core', callback=lambda func: func)
+    try:
+        import voluptuous  # noqa: F401
+    except ImportError:
+        _stub_module('voluptuous')
+
+
+install_stubs()
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'custom_components'))
+from owlintuition import sensor as owl  # noqa: E402
+
+SAMPLE = os.path.join(os.path.dirname(owl.__file__), 'sample.owl2.xml')
+BASE_TS = 1543140910
+
+
+#
+# Synthetic packets generators: the i-th packet always differs from the
+# previous one, so that it is not dropped as a duplicate
+#
+
+def gen_sample(i, _count):
+    """sample.owl2.xml with an increasing timestamp"""
+    with open(SAMPLE, 'rb') as f:
+        sample = f.read()
+    return sample.replace(b'<timestamp>%d</timestamp>' % BASE_TS,
+                          b'<timestamp>%d</timestamp>' % (BASE_TS + i))
+
+
+def gen_electricity_v2(i, channels):
+    chans = ''.join(f'<chan id="{c}"><curr units="w">{100 + c + i % 50}.00</curr>'
+                    f'<day units="wh">{1000 + c * 10 + i}.00</day></chan>'
+                    for c in range(channels))
+    return (f'<electricity id="44371914A0F4" ver="2.0"><timestamp>{BASE_TS + i}</timestamp>'
+            f'<signal rssi="-77" lqi="47" /><battery level="100%" />'
+            f'<channels>{chans}</channels><property><current><watts>{275 + i % 50}.00</watts>'
+            f'<cost>3.28</cost></current><day><wh>{1969 + i}.24</wh><cost>41.06</cost></day>'
+            f'<tariff time="1543144510"><start>1543104000</start><curr_price>0.12</curr_price>'
+            f'<block_limit>4294967295</block_limit><block_usage>1480</block_usage></tariff>'
+            f'</property></electricity>').encode()
+
+
+def gen_electricity_legacy(i, channels):
+    chans = ''.join(f'<chan id="{c}"><curr units="w">{100 + c + i % 50}.00</curr>'
+                    f'<day units="wh">{1000 + c * 10 + i}.00</day></chan>'
+                    for c in range(channels))
+    return (f'<electricity id="44371914A0F4"><signal rssi="-77" lqi="47"/>'
+            f'<battery level="100%"/>{chans}</electricity>').encode()
+
+
+def gen_solar(i, _count):
+    return (f'<solar id="44371914A0F4" ver="2.0"><timestamp>{BASE_TS + i}</timestamp>'
+            f'<current><generating units="w">{1000 + i % 50}.00</generating>'
+            f'<exporting units="w">{300 + i % 50}.00</exporting></current>'
+            f'<day><generated units="wh">{5000 + i}.00</generated>'
+            f'<exported units="wh">{1000 + i}.00</exported></day></solar>').encode()
+
+
+def _gen_zones(tag, i, zones, ver, ambient):
+    ver_attr = ' ver="2"' if ver else ''
+    body = ''.join(f'<zone id="{20000 + z}"><signal rssi="-70" lqi="9"/><battery level="2800"/>'
+                   f'<temperature state="{(i + z) % 2}"><current>{20 + (i % 50) / 10:.2f}</current>'
+                   f'<required>21.00</required>{ambient}</temperature></zone>'
+                   for z in range(zones))
+    return (f'<{tag} id="44371914A0F4"{ver_attr}><timestamp>{BASE_TS + i}</timestamp>'
+            f'<zones>{body}</zones></{tag}>').encode()
+
+
+def gen_heating(i, zones):
+    return _gen_zones('heating', i, zones, True, '')
+
+
+def gen_heating_legacy(i, zones):
+    return _gen_zones('heating', i, zones, False, '')
+
+
+def gen_hot_water(i, zones):
+    return _gen_zones('hot_water', i, zones, True, '<ambient>19.00</ambient>')
+
+
+def gen_relays(i, zones):
+    body = ''.join(f'<zone id="{30000 + z}"><signal rssi="{-60 - i % 20}" lqi="9"/></zone>'
+                   for z in range(zones))
+    return (f'<relays id="44371914A0F4" ver="2"><timestamp>{BASE_TS + i}</timestamp>'
+            f'<zones>{body}</zones></relays>').encode()
+
+
+def make_entities(owldata, owlclass, count, throttle=None):
+    """Create the entities a platform would create for the given class,
+    zones (or channels) count, and subscribe them to the OwlData"""
+    entities = []
+    zones = count if owlclass in owl.ZONED_CLASSES else 1
+    for sensor_type, props in owl.SENSOR_TYPES.items():
+        if props[3] == owlclass:
+            for zone in range(zones):
+                entities.append(owl.OwlIntuitionSensor(owldata, 'OWL', sensor_type,
+                                                       zone=zone, zones_count=zones, throttle=throttle))
+    if owlclass == owl.OWLCLASS_ELECTRICITY:
+        for phase in range(1, min(count, 3) + 1):
+            entities.append(owl.OwlIntuitionSensor(owldata, 'OWL', owl.SENSOR_ELECTRICITY_POWER,
+                                                   phase=phase, throttle=throttle))
+            entities.append(owl.OwlIntuitionSensor(owldata, 'OWL', owl.SENSOR_ELECTRICITY_ENERGY_TODAY,
+                                                   phase=phase, throttle=throttle))
+    for entity in entities:
+        owldata.subscribe(owlclass, entity._async_data_received)
+    return entities
+
+
+def check_decoders(scenarios, packets):
+    """Check that the fast decoders decode the packets, and their
+    single-quoted variants, exactly as the tree decoders do, and that
+    with the fallback the packets of other layouts are decoded the same"""
+    owldata = owl.OwlData(None, decoder=owl.DECODER_FAST)
+    for name, owlclass, generator, count in scenarios:
+        for i in range(packets):
+            payload = generator(i, count)
+            layouts = (re.sub(rb'<chan id="[^"]*">', b'<chan>', payload),
+                       re.sub(rb'(<curr[^>]*>[^<]*</curr>)(<day[^>]*>[^<]*</day>)', rb'\2\1', payload))
+            for variant in (payload, payload.replace(b'"', b"'")) + layouts:
+                root, device_id, xml_ver = owl._root_of(variant)
+                tree = owl.OWL_DECODERS[root](owl.ET.fromstring(variant))
+                if variant in layouts:
+                    _, fast, _, _ = owldata._decode(variant, root, device_id, xml_ver)
+                else:
+                    fast = owl.FAST_DECODERS[(root, xml_ver.split('.')[0] if xml_ver else None)](
+                        variant, root, device_id, xml_ver)
+                assert asdict(fast) == asdict(tree), f"{name} ({count}): {asdict(fast)} != {asdict(tree)}"
+
+
+def run_scenario(name, owlclass, generator, count, packets, decoder, throttle=None):
+    """Run a scenario and return its row of results"""
+    payloads = [generator(i, count) for i in range(packets)]
+
+    # parse and decode only, with no subscribers
+    owldata = owl.OwlData(None, decoder=decoder)
+    start = time.perf_counter()
+    for payload in payloads:
+        owldata.on_data_received(payload)
+    parse_us = (time.perf_counter() - start) / packets * 1e6
+
+    # per-entity update from the last snapshot
+    entities = make_entities(owldata, owlclass, count, throttle)
+    start = time.perf_counter()
+    for _ in range(packets):
+        for entity in entities:
+            entity.update()
+    update_us = (time.perf_counter() - start) / (packets * len(entities)) * 1e6
+
+    # end-to-end with the allocations traced separately, as tracing
+    # skews the timings
+    for traced in (False, True):
+        owldata = owl.OwlData(None, decoder=decoder)
+        make_entities(owldata, owlclass, count, throttle)
+        _SensorEntity.writes = 0
+        if traced:
+            tracemalloc.start()
+        start = time.perf_counter()
+        for payload in payloads:
+            owldata.on_data_received(payload)
+        elapsed = time.perf_counter() - start
+        if traced:
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        else:
+            pkts_s = packets / elapsed
+            writes = _SensorEntity.writes
+
+    return (name, count, len(entities), parse_us, update_us, pkts_s,
+            writes / packets, peak / 1024, owldata.counters[owl.COUNTER_ACCEPTED])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--packets', type=int, default=2000)
+    parser.add_argument('--channels', type=int, nargs='+', default=[3, 6])
+    parser.add_argument('--zones', type=int, nargs='+', default=[1, 4, 8])
+    parser.add_argument('--decoders', nargs='+', default=[owl.DECODER_TREE, owl.DECODER_FAST],
+                        choices=[owl.DECODER_TREE, owl.DECODER_FAST])
+    parser.add_argument('--delta-pct', type=float,
+                        help='only write the states changing by at least this percentage')
+    args = parser.parse_args()
+    throttle = None
+    if args.delta_pct is not None:
+        throttle = {owlclass: {owl.CONF_THROTTLE_DELTA_PCT: args.delta_pct} for owlclass in owl.OWL_CLASSES}
+
+    scenarios = [('sample.owl2.xml', owl.OWLCLASS_ELECTRICITY, gen_sample, 6),
+                 ('solar', owl.OWLCLASS_SOLAR, gen_solar, 1)]
+    for channels in args.channels:
+        scenarios.append(('electricity v2', owl.OWLCLASS_ELECTRICITY, gen_electricity_v2, channels))
+        scenarios.append(('electricity legacy', owl.OWLCLASS_ELECTRICITY, gen_electricity_legacy, channels))
+    for zones in args.zones:
+        scenarios.append(('heating v2', owl.OWLCLASS_HEATING, gen_heating, zones))
+        scenarios.append(('heating legacy', owl.OWLCLASS_HEATING, gen_heating_legacy, zones))
+        scenarios.append(('hot_water v2', owl.OWLCLASS_HOTWATER, gen_hot_water, zones))
+        scenarios.append(('relays', owl.OWLCLASS_RELAYS, gen_relays, zones))
+
+    check_decoders(scenarios, min(args.packets, 100))
+    print(f"{'scenario':<20}{'decoder':>8}{'n':>4}{'ents':>6}{'parse us':>10}{'upd us':>9}"
+          f"{'pkts/s':>10}{'writes/pkt':>12}{'peak KiB':>10}{'accepted':>10}")
+    for scenario in scenarios:
+        for decoder in args.decoders:
+            name, *results = run_scenario(*scenario, args.packets, decoder, throttle)
+            print('{:<20}{:>8}{:>4}{:>6}{:>10.1f}{:>9.2f}{:>10.0f}{:>12.1f}{:>10.1f}{:>10}'.format(
+                name, decoder, *results))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+#!/usr/bin/python3
+#
+# Offline replay of the capture files recorded with the `capture` option of
+# the OWL Intuition platform: the datagrams are fed to OwlData.on_data_received()
+# as fast as possible, to measure the throughput, or with their original
+# timing, to reproduce an issue. With --workers, the packets are decoded by
+# that many worker threads, as with the `workers` option, and the replay
+# ends once all of them are stored. The homeassistant modules are stubbed as
+# in benchowl.py. Usage:
+#
+#   python3 test/replayowl.py [--realtime | --workers 2] [--decoder fast] [--monitored electricity]
+#                             owlintuition_owl_intuition.owlcap.1 owlintuition_owl_intuition.owlcap
+#
+# Rotated files are replayed in the order given, hence oldest first.
+
+import argparse
+import asyncio
+import json
+import time
+
+from benchowl import owl
+
+
+async def replay_with_workers(owldata, captures, workers):
+    """Replay the captures from an event loop, as the listener would, and
+    wait for the workers to decode all the packets. Returns the count."""
+    owldata._workers = workers
+    owldata.start_workers(asyncio.get_running_loop())
+    count = 0
+    try:
+        for capture in captures:
+            for _, source, datagram in owl.read_capture(capture):
+                owldata.on_data_received(datagram, source)
+                count += 1
+                if count % 100 == 0:
+                    # let the loop store the snapshots already decoded
+                    await asyncio.sleep(0)
+        while owldata.queue_pending:
+            await asyncio.sleep(0.001)
+    finally:
+        owldata.stop_workers()
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description='OWL Intuition capture replay')
+    parser.add_argument('captures', nargs='+', help='capture files, oldest first')
+    parser.add_argument('--realtime', action='store_true', help='replay with the original timing')
+    parser.add_argument('--decoder', default=owl.DECODER_TREE, choices=[owl.DECODER_TREE, owl.DECODER_FAST])
+    parser.add_argument('--monitored', nargs='+', choices=owl.OWL_CLASSES)
+    parser.add_argument('--workers', type=int, default=0, help='decode in that many worker threads')
+    parser.add_argument('--verbose', action='store_true', help='print the diagnostics of the replay')
+    args = parser.parse_args()
+    if args.workers and args.realtime:
+        parser.error('--workers cannot be used with --realtime')
+
+    owldata = owl.OwlData(None, monitored=args.monitored, decoder=args.decoder)
+    count = 0
+    start = time.perf_counter()
+    if args.workers:
+        count = asyncio.run(replay_with_workers(owldata, args.captures, args.workers))
+    else:
+        for capture in args.captures:
+            count += owl.replay_capture(owldata, capture, realtime=args.realtime)
+    elapsed = time.perf_counter() - start
+
+    print(f"replayed: {count}, elapsed: {elapsed:.3f}s, pkts/s: {count / elapsed if elapsed else 0:.0f}")
+    print(', '.join(f'{key}: {value}' for key, value in sorted(owldata.counters.items())))
+    if args.verbose:
+        print(json.dumps(owldata.diagnostics(), indent=2))
+
+
+if __name__ == '__main__':
+    main()
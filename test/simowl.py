@@ -0,0 +1,202 @@
+#!/usr/bin/python3
+#
+# Simulator of an OWL Intuition network station, to stress the receive path
+# of the integration without the physical device. Packets are sent either
+# unicast to a given host and port (the OWL "data push" setup), or to the
+# multicast group the station uses by default.
+#
+# Examples:
+#
+#   # 100 packets/s of mixed electricity and heating data to a data push port
+#   python3 test/simowl.py --port 4321 --rate 100 --classes electricity heating
+#
+#   # multicast on loopback, with bursts, 1% malformed and 1% oversize packets
+#   python3 test/simowl.py --interface 127.0.0.1 --rate 500 --burst 10 \
+#       --malformed 0.01 --oversize 0.01
+#
+#   # replay a capture with its original timing
+#   python3 test/simowl.py --port 4321 --replay capture.txt
+#   python3 test/simowl.py --port 4321 --replay owlintuition_owl_intuition.owlcap
+#
+#   # measure the drop rate of an in-process OwlData listener on loopback
+#   python3 test/simowl.py --interface 127.0.0.1 --rate 1000 --count 5000 --selftest
+#
+# Capture files for --replay are either those recorded by the platform with
+# its `capture` option, or text files holding one packet per line, as the
+# receive time in seconds followed by a tab and the XML packet on a single line.
+
+import argparse
+import asyncio
+import logging
+import random
+import socket
+import sys
+import time
+import types
+
+import benchowl
+from benchowl import owl
+
+GENERATORS = {
+    owl.OWLCLASS_ELECTRICITY: benchowl.gen_electricity_v2,
+    'electricity_legacy': benchowl.gen_electricity_legacy,
+    owl.OWLCLASS_SOLAR: benchowl.gen_solar,
+    owl.OWLCLASS_HEATING: benchowl.gen_heating,
+    owl.OWLCLASS_HOTWATER: benchowl.gen_hot_water,
+    owl.OWLCLASS_RELAYS: benchowl.gen_relays,
+}
+
+# large enough to exceed the size of any datagram sent by a real station
+OVERSIZE_COUNT = 64
+
+
+def open_socket(args):
+    """Create the sending socket and return it with the destination"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    if args.port:
+        return sock, (args.host, args.port)
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, args.ttl)
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(args.interface))
+    return sock, (args.group, args.group_port)
+
+
+def generate(args):
+    """Yield (delay, packet) tuples according to the configured traffic"""
+    rnd = random.Random(args.seed)
+    seq = dict.fromkeys(args.classes, 0)
+    sent = 0
+    while not args.count or sent < args.count:
+        for _ in range(args.burst):
+            owlclass = rnd.choice(args.classes)
+            seq[owlclass] += 1
+            count = args.channels if 'electricity' in owlclass else args.zones
+            if rnd.random() < args.oversize:
+                count = OVERSIZE_COUNT
+            packet = GENERATORS[owlclass](seq[owlclass], count)
+            if rnd.random() < args.malformed:
+                packet = packet[:rnd.randrange(1, len(packet))]
+            yield 0, packet
+            sent += 1
+            if args.count and sent >= args.count:
+                return
+        yield args.burst / args.rate, None
+
+
+def read_text_capture(path):
+    """Yield the (receive time, packet) records of a text capture file"""
+    with open(path, 'rb') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            stamp, packet = line.rstrip(b'\r\n').split(b'\t', 1)
+            yield float(stamp), packet
+
+
+def replay(args):
+    """Yield (delay, packet) tuples from a capture file"""
+    try:
+        records = [(stamp, packet) for stamp, _, packet in owl.read_capture(args.replay)]
+    except ValueError:
+        records = read_text_capture(args.replay)
+    last = None
+    for stamp, packet in records:
+        delay = 0 if last is None else max(stamp - last, 0) / args.speed
+        last = stamp
+        yield delay, packet
+
+
+def send(args, stats):
+    """Send the traffic, pacing it against the wall clock"""
+    sock, dest = open_socket(args)
+    source = replay(args) if args.replay else generate(args)
+    deadline = time.monotonic()
+    start = deadline
+    with sock:
+        for delay, packet in source:
+            deadline += delay
+            pause = deadline - time.monotonic()
+            if pause > 0:
+                time.sleep(pause)
+            if packet is None:
+                continue
+            try:
+                sock.sendto(packet, dest)
+                stats['sent'] += 1
+                stats['bytes'] += len(packet)
+            except OSError as err:
+                stats['errors'] += 1
+                if stats['errors'] == 1:
+                    print(f"Unable to send to {dest}: {err}", file=sys.stderr)
+            if args.duration and time.monotonic() - start > args.duration:
+                break
+    stats['elapsed'] = time.monotonic() - start
+
+
+async def selftest(args, stats):
+    """Run an OwlData listener in-process and send the traffic to it"""
+    logging.getLogger(owl.__name__).setLevel(logging.CRITICAL)
+    loop = asyncio.get_running_loop()
+    owldata = owl.OwlData((args.interface if not args.port else args.host,
+                           args.port, args.group, args.group_port))
+    received = [0]
+    on_data_received = owldata.on_data_received
+
+    def counting(packet, source=None):
+        received[0] += 1
+        on_data_received(packet, source)
+
+    owldata.on_data_received = counting
+    if not await owldata.async_start(types.SimpleNamespace(loop=loop)):
+        sys.exit(1)
+    try:
+        await loop.run_in_executor(None, send, args, stats)
+        await asyncio.sleep(0.5)
+        stats.update(owl._LISTENERS[owldata._binding].counters)
+    finally:
+        owldata.async_stop()
+    stats['received'] = received[0]
+    stats.update(owldata.counters)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='OWL Intuition network station simulator')
+    parser.add_argument('--host', default='127.0.0.1', help='destination of unicast packets')
+    parser.add_argument('--port', type=int, help='unicast port; multicast is used if omitted')
+    parser.add_argument('--group', default=owl.DEFAULT_BROADCAST_ADDRESS)
+    parser.add_argument('--group-port', type=int, default=owl.DEFAULT_BROADCAST_PORT)
+    parser.add_argument('--interface', default='127.0.0.1', help='multicast interface address')
+    parser.add_argument('--ttl', type=int, default=1)
+    parser.add_argument('--rate', type=float, default=10, help='packets per second')
+    parser.add_argument('--count', type=int, default=0, help='packets to send, 0 for no limit')
+    parser.add_argument('--duration', type=float, default=0, help='seconds to run, 0 for no limit')
+    parser.add_argument('--classes', nargs='+', default=[owl.OWLCLASS_ELECTRICITY],
+                        choices=sorted(GENERATORS))
+    parser.add_argument('--channels', type=int, default=3)
+    parser.add_argument('--zones', type=int, default=1)
+    parser.add_argument('--burst', type=int, default=1, help='packets sent back-to-back')
+    parser.add_argument('--malformed', type=float, default=0, help='probability of truncated XML')
+    parser.add_argument('--oversize', type=float, default=0, help='probability of oversize packets')
+    parser.add_argument('--replay', help='capture file to replay')
+    parser.add_argument('--speed', type=float, default=1, help='replay speed factor')
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--selftest', action='store_true',
+                        help='receive with an in-process OwlData and report the drop rate')
+    args = parser.parse_args()
+
+    stats = {'sent': 0, 'bytes': 0, 'errors': 0}
+    try:
+        if args.selftest:
+            asyncio.run(selftest(args, stats))
+        else:
+            send(args, stats)
+    except KeyboardInterrupt:
+        pass
+    print(', '.join(f'{key}: {value:.2f}' if isinstance(value, float) else f'{key}: {value}'
+                    for key, value in stats.items()))
+    if args.selftest and stats['sent']:
+        print(f"drop rate: {1 - stats['received'] / stats['sent']:.2%}")
+
+
+if __name__ == '__main__':
+    main()